@@ -0,0 +1,519 @@
+import asyncio
+import contextlib
+import json
+import logging
+import time
+
+import cohere
+import httpx
+from google.genai.types import Content
+from starlette.applications import Starlette
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.exceptions import HTTPException
+
+from main import (
+    Deadline,
+    ANSWER_CONFIG,
+    COHERE_API_KEY,
+    COHERE_BASE_URL,
+    COHERE_REQUEST_OPTIONS,
+    KEYWORD_CONFIG,
+    REQUEST_DEADLINE,
+    RERANK_TIMEOUT,
+    RERANK_TOP_N,
+    METRICS_MIMETYPE,
+    OUTBOUND_POOL_SIZE,
+    OUTBOUND_RETRIES,
+    PREWARM,
+    PREWARM_SERVICES,
+    READY_SERVICES,
+    STARTUP_SERVICES,
+    STREAM_MIMETYPES,
+    TRANSCRIBE_CONFIG,
+    WEB_RETRIEVAL,
+    answer_instruction,
+    cache_references,
+    cached_references,
+    compact_history,
+    done_event,
+    filter_urls,
+    flag,
+    format_event,
+    get_client,
+    google_search_async,
+    has_pack,
+    history_fingerprint,
+    media_cache_key,
+    media_part,
+    ingest_urls,
+    keyword_instruction,
+    local_rerank,
+    metrics,
+    model_id,
+    observe_request,
+    pack_references,
+    query_candidates,
+    rate_limiter,
+    readiness,
+    record_cache,
+    record_usage,
+    reference_queries,
+    rerank_flight_key,
+    retry_delay,
+    retryable,
+    response_cache,
+    server_timing,
+    spool_media,
+    start_recrawl,
+    start_warmup,
+    transcript_cache,
+    wants_stream,
+    with_instruction,
+    with_timeout,
+)
+
+# Async serving mode for the same "/" contract as the Flask app in main.py, every
+# model/search call awaits instead of holding a worker thread. Run with:
+#   uvicorn asgi:app --app-dir lib --workers 1
+
+# Async Cohere client, built on first rerank like the sync one
+co_async = None
+
+
+def get_cohere_async():
+    global co_async
+    if co_async is None:
+        co_async = cohere.AsyncClient(
+            COHERE_API_KEY,
+            base_url=COHERE_BASE_URL,
+            httpx_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=OUTBOUND_POOL_SIZE,
+                    max_keepalive_connections=OUTBOUND_POOL_SIZE,
+                ),
+                timeout=RERANK_TIMEOUT * 2,
+            ),
+        )
+    return co_async
+
+
+# (service, flight key) -> task of the call identical requests are waiting on
+in_flight = {}
+
+
+async def call_with_retry_async(service, fn, kwargs, deadline=None):
+    for attempt in range(OUTBOUND_RETRIES + 1):
+        await asyncio.sleep(rate_limiter(service).reserve())
+        try:
+            return await fn(**kwargs)
+        except Exception as e:
+            delay = retry_delay(attempt)
+            out_of_time = deadline is not None and delay >= deadline.remaining()
+            if attempt == OUTBOUND_RETRIES or not retryable(e) or out_of_time:
+                metrics.inc("outbound_errors", service=service)
+                raise
+            metrics.inc("outbound_retries", service=service)
+            logging.warning(f"{service} call failed ({e!r}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+
+async def outbound_async(service, fn, flight_key=None, deadline=None, **kwargs):
+    # Same contract as outbound in main.py, coalescing on tasks instead of futures
+    if flight_key is None:
+        return await call_with_retry_async(service, fn, kwargs, deadline)
+    key = (service, flight_key)
+    task = in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(
+            call_with_retry_async(service, fn, kwargs, deadline)
+        )
+        in_flight[key] = task
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+    else:
+        metrics.inc("coalesced_calls", service=service)
+    # Shielded so a waiter that gets cancelled does not cancel the others' call
+    return await asyncio.shield(task)
+
+
+async def run_stage_async(name, coro, timings, deadline, skipped):
+    # Same contract as run_stages: a stage that fails or outlives its budget is
+    # cancelled, added to skipped and returns None. Work it handed to a thread
+    # still runs to the end.
+    start = time.perf_counter()
+    try:
+        return await asyncio.wait_for(coro, deadline.budget(name))
+    except Exception as e:
+        logging.warning(f"Skipping stage {name}: {e!r}")
+        skipped.append(name)
+        return None
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+async def transcribe_async(media, cache_key=None):
+    if cache_key is not None:
+        transcription = await asyncio.to_thread(transcript_cache.get, cache_key)
+        record_cache("transcript", transcription is not None)
+        if transcription is not None:
+            logging.info(f"Transcript cache hit: {cache_key}")
+            return transcription
+
+    with metrics.time("stage_seconds", stage="transcribe"):
+        response = await outbound_async(
+            "gemini",
+            get_client().aio.models.generate_content,
+            flight_key=cache_key,
+            model=model_id,
+            contents=[Content(role="user", parts=[media])],
+            config=TRANSCRIBE_CONFIG,
+        )
+    record_usage("transcribe", response)
+
+    if cache_key is not None and response.text:
+        await asyncio.to_thread(transcript_cache.set, cache_key, response.text)
+    return response.text
+
+
+async def generate_keywords_async(contents, query, emergency_type):
+    with metrics.time("stage_seconds", stage="keywords"):
+        response = await outbound_async(
+            "gemini",
+            get_client().aio.models.generate_content,
+            model=model_id,
+            contents=contents,
+            config=with_instruction(
+                KEYWORD_CONFIG, keyword_instruction(query, emergency_type)
+            ),
+        )
+    record_usage("keywords", response)
+    return json.loads(response.text)
+
+
+async def retrieve_and_rerank_async(
+    db_query, rerank_query, timeout=RERANK_TIMEOUT, skipped=None, emergency_type=None
+):
+    # Chroma has no async client, its query runs on a worker thread
+    docs = await asyncio.to_thread(query_candidates, db_query, emergency_type)
+    if not docs:
+        return []
+    start = time.perf_counter()
+    try:
+        reranked_docs = await asyncio.wait_for(
+            outbound_async(
+                "cohere",
+                get_cohere_async().rerank,
+                flight_key=rerank_flight_key(rerank_query, docs),
+                query=rerank_query,
+                documents=docs,
+                top_n=min(RERANK_TOP_N, len(docs)),
+                model="rerank-v3.5",
+                request_options=COHERE_REQUEST_OPTIONS,
+            ),
+            timeout,
+        )
+    except Exception as e:
+        logging.warning(f"Cohere rerank failed ({e!r}), reranking locally")
+        metrics.inc("rerank_fallbacks")
+        if skipped is not None:
+            skipped.append("rerank")
+        return await asyncio.to_thread(local_rerank, rerank_query, docs)
+    metrics.observe("stage_seconds", time.perf_counter() - start, stage="rerank")
+    return [docs[result.index] for result in reranked_docs.results]
+
+
+async def find_references_async(keywords, emergency_type, deadline, skipped):
+    queries = reference_queries(keywords)
+    if queries is None:
+        return None
+    db_query, rerank_query = queries
+    references = cached_references(emergency_type, db_query)
+    if references is not None:
+        return references
+    if WEB_RETRIEVAL:
+        try:
+            urls = await asyncio.wait_for(
+                google_search_async(db_query), deadline.budget("search")
+            )
+        except Exception as e:
+            logging.warning(f"Skipping stage search: {e!r}")
+            skipped.append("search")
+            return None
+        filtered_urls = await asyncio.to_thread(filter_urls, urls)
+        try:
+            await asyncio.to_thread(
+                ingest_urls, filtered_urls, timeout=deadline.budget("crawl")
+            )
+        except TimeoutError:
+            skipped.append("crawl")
+    elif not has_pack(emergency_type):
+        return None
+    references = await retrieve_and_rerank_async(
+        db_query,
+        rerank_query,
+        timeout=deadline.budget("rerank"),
+        skipped=skipped,
+        emergency_type=emergency_type,
+    )
+    cache_references(emergency_type, db_query, references, skipped)
+    return references
+
+
+async def pipeline_events_async(
+    contents,
+    media,
+    media_key,
+    query,
+    emergency_type,
+    cache_bucket,
+    stream,
+    timings,
+    skipped,
+    deadline,
+):
+    # Same stage graph and budgets as pipeline_events: keywords -> references runs
+    # as one task next to transcription, unless a knowledge pack answers the question
+
+    async def keywords_then_references():
+        keywords = await run_stage_async(
+            "keywords",
+            generate_keywords_async(contents, query, emergency_type),
+            timings,
+            deadline,
+            skipped,
+        )
+        return await run_stage_async(
+            "references",
+            find_references_async(keywords, emergency_type, deadline, skipped),
+            timings,
+            deadline,
+            skipped,
+        )
+
+    references = pack_references(emergency_type, query)
+    references_task = None
+    if references is None:
+        references_task = asyncio.create_task(keywords_then_references())
+    transcription = None
+    try:
+        if media is not None:
+            transcription = await run_stage_async(
+                "transcription",
+                transcribe_async(media, media_key),
+                timings,
+                deadline,
+                skipped,
+            )
+            yield {"type": "transcription", "transcription": transcription}
+        if references_task is not None:
+            references = await references_task
+    finally:
+        if references_task is not None:
+            references_task.cancel()
+
+    config = with_timeout(
+        with_instruction(
+            ANSWER_CONFIG, answer_instruction(query, emergency_type, references)
+        ),
+        deadline.remaining(),
+    )
+
+    start = time.perf_counter()
+    if stream:
+        parts = []
+        response = None
+        await asyncio.sleep(rate_limiter("gemini").reserve())
+        chunks = await asyncio.wait_for(
+            get_client().aio.models.generate_content_stream(
+                model=model_id, contents=contents, config=config
+            ),
+            deadline.remaining(),
+        )
+        async for response in chunks:
+            if response.text:
+                parts.append(response.text)
+                yield {"type": "delta", "text": response.text}
+        text = "".join(parts)
+    else:
+        response = await asyncio.wait_for(
+            outbound_async(
+                "gemini",
+                get_client().aio.models.generate_content,
+                deadline=deadline,
+                model=model_id,
+                contents=contents,
+                config=config,
+            ),
+            deadline.remaining(),
+        )
+        text = response.text
+    timings["answer"] = time.perf_counter() - start
+    metrics.observe("stage_seconds", timings["answer"], stage="answer")
+    record_usage("answer", response)
+    if cache_bucket is not None and text and not skipped:
+        await asyncio.to_thread(response_cache.set, cache_bucket, query, text)
+
+    yield done_event(text, transcription, timings, skipped)
+
+
+def json_response(body, headers=None):
+    return Response(
+        json.dumps(body, ensure_ascii=False),
+        status_code=200,
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+async def ai_pipeline(request):
+    media = None
+    if request.headers.get("content-type", "").startswith("application/json"):
+        data = await request.json()
+    else:
+        data = await request.form()
+        for field in ("audio", "video", "image"):
+            media = data.get(field)
+            if media is not None:
+                break
+    deadline = Deadline(REQUEST_DEADLINE)
+    message_history = json.loads(data["chat_history"])
+    query = data["query"]
+    emergency_type = data["emergency_type"]
+    stream_format = wants_stream(data, request.headers.get("accept", ""))
+    profile = flag(data, "profile")
+    content_length = int(request.headers.get("content-length", 0))
+
+    # Text-only requests can be answered from earlier near-identical questions
+    cache_bucket = None
+    if media is None:
+        observe_request(content_length)
+        cache_bucket = (emergency_type, history_fingerprint(message_history, query))
+        cached_response = await asyncio.to_thread(
+            response_cache.get, cache_bucket, query
+        )
+        if cached_response is not None:
+            logging.info(f"Response cache hit: {query}")
+            if stream_format:
+                event = {
+                    "type": "done",
+                    "response": cached_response,
+                    "transcription": None,
+                }
+                return Response(
+                    format_event(event, stream_format),
+                    media_type=STREAM_MIMETYPES[stream_format],
+                )
+            return json_response({"response": cached_response, "transcription": None})
+
+    contents = await asyncio.to_thread(
+        compact_history, message_history, data.get("session_id"), deadline
+    )
+    part = None
+    media_key = None
+    if media is not None:
+        # Starlette already spooled the upload, copy it over with the size limit
+        # applied and build the Part off the event loop
+        try:
+            spooled, size, digest = await asyncio.to_thread(spool_media, media.file)
+            observe_request(content_length, size)
+            with spooled:
+                part = await asyncio.to_thread(
+                    media_part, spooled, size, media.content_type, deadline
+                )
+        except HTTPException as e:
+            # Too large (413), failed processing (422) or still processing (504)
+            return Response(e.description, status_code=e.code)
+        media_key = media_cache_key(digest, media.content_type)
+        contents.append(Content(role="user", parts=[part]))
+
+    timings = {}
+    skipped = []
+    events = pipeline_events_async(
+        contents,
+        part,
+        media_key,
+        query,
+        emergency_type,
+        cache_bucket,
+        stream_format is not None,
+        timings,
+        skipped,
+        deadline,
+    )
+    if stream_format:
+
+        async def body():
+            async for event in events:
+                yield format_event(event, stream_format)
+
+        return StreamingResponse(
+            body(),
+            media_type=STREAM_MIMETYPES[stream_format],
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    result = None
+    async for event in events:
+        result = event
+    body = {
+        "response": result["response"],
+        "transcription": result["transcription"],
+        "skipped_stages": result["skipped_stages"],
+    }
+    if profile:
+        body["timings"] = result["timings"]
+    return json_response(
+        body,
+        headers={"Server-Timing": server_timing(timings)},
+    )
+
+
+async def cache_stats(request):
+    return json_response({"response_cache": response_cache.stats()})
+
+
+async def metrics_endpoint(request):
+    return Response(metrics.render(), media_type=METRICS_MIMETYPE)
+
+
+async def healthz(request):
+    return Response("ok", media_type="text/plain")
+
+
+async def readyz(request):
+    services = readiness()
+    ready = all(services[name] for name in READY_SERVICES)
+    return Response(
+        json.dumps({"ready": ready, "services": services}),
+        status_code=200 if ready else 503,
+        media_type="application/json",
+    )
+
+
+async def warmup(request):
+    start_warmup(PREWARM_SERVICES)
+    return Response(
+        json.dumps({"services": readiness()}),
+        status_code=202,
+        media_type="application/json",
+    )
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    start_warmup(PREWARM_SERVICES if PREWARM else STARTUP_SERVICES)
+    start_recrawl()
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route("/", ai_pipeline, methods=["POST"]),
+        Route("/cache/stats", cache_stats, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
+        Route("/healthz", healthz, methods=["GET"]),
+        Route("/readyz", readyz, methods=["GET"]),
+        Route("/warmup", warmup, methods=["POST"]),
+    ],
+    lifespan=lifespan,
+)
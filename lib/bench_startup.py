@@ -0,0 +1,53 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Cold-start benchmark: each run imports main in a fresh interpreter, which is what a
+# new worker pays before it can take text-only requests, then loads every service
+# the way PREWARM does. Run with:
+#   python lib/bench_startup.py --runs 5
+
+PROBE = """
+import time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.warm(main.READY_SERVICES)
+ready = time.perf_counter()
+main.warm(main.PREWARM_SERVICES)
+warmed = time.perf_counter()
+main.crawler_service.stop()
+print(imported - start, ready - start, warmed - start)
+"""
+
+
+def run_once():
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    # The timings are the last line, anything before it is startup logging
+    return [float(value) for value in output.strip().splitlines()[-1].split()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold-start time of main.py")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    for i, label in enumerate(("import", "ready", "prewarmed")):
+        values = [run[i] for run in runs]
+        print(
+            f"{label:>10}: median {statistics.median(values):.2f}s, "
+            f"min {min(values):.2f}s, max {max(values):.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import re
+from concurrent.futures import ProcessPoolExecutor
+from html import unescape
+
+# Text extraction for crawled pages. Kept out of main.py so the process pool in
+# clean_html_batch and the benchmarks under tests/ import only this module.
+
+HTML_TAG_PATTERN = re.compile(r"<[^>]+>")
+
+
+def clean_html(html_content):
+    # Remove HTML tags
+    text = HTML_TAG_PATTERN.sub("", html_content)
+
+    # Decode HTML entities
+    if "&" in text:
+        text = unescape(text)
+
+    # Replace escape sequences, then split/join collapses newlines, tabs and
+    # other whitespace runs and strips the ends in a single sweep
+    text = text.replace("\\n", " ").replace("\\t", " ")
+    return " ".join(text.split())
+
+
+def clean_html_batch(pages, max_workers=None):
+    # Clean many pages on a process pool, results keep the input order
+    pages = list(pages)
+    if len(pages) < 2:
+        return [clean_html(page) for page in pages]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(clean_html, pages, chunksize=4))
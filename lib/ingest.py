@@ -0,0 +1,177 @@
+import argparse
+import json
+import logging
+import os
+
+from main import (
+    crawler_service,
+    edit_knowledge_packs,
+    filter_urls,
+    google_search,
+    ingest_urls,
+    pack_key,
+    retrieve_and_rerank,
+    tag_documents,
+)
+
+# Bulk corpus building outside the request path: seed queries are searched, the
+# resulting URLs and any seed URLs are crawled in rounds and loaded into Chroma in
+# large batches. Progress is checkpointed after every round so an interrupted run
+# picks up where it stopped. Run with:
+#   python lib/ingest.py --queries seeds.txt --urls urls.txt
+# With --emergency-type the pages form that type's knowledge pack, and the top
+# references for each line of --pack-queries are precomputed into it.
+
+INGEST_CHECKPOINT = os.getenv("INGEST_CHECKPOINT", "ingest_checkpoint.json")
+
+
+def read_lines(path):
+    # One entry per line, blank lines and "#" comments are ignored
+    if path is None:
+        return []
+    with open(path, encoding="utf-8") as f:
+        lines = (line.strip() for line in f)
+        return [line for line in lines if line and not line.startswith("#")]
+
+
+def new_checkpoint():
+    # Searched queries, URLs waiting to be crawled and URLs already tried
+    return {"queries": [], "pending": [], "attempted": []}
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return new_checkpoint()
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_json(path, data):
+    # Write to a temporary file first so a crash never leaves half a file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def search_seeds(queries, checkpoint, checkpoint_path):
+    searched = set(checkpoint["queries"])
+    for query in queries:
+        if query in searched:
+            continue
+        try:
+            urls = google_search(query)
+        except Exception:
+            # Logged by google_search, the query is retried on the next run
+            continue
+        checkpoint["pending"].extend(urls)
+        checkpoint["queries"].append(query)
+        searched.add(query)
+        write_json(checkpoint_path, checkpoint)
+        logging.info(f"Searched {query!r}: {len(urls)} URLs")
+
+
+def crawl_pending(checkpoint, checkpoint_path, args):
+    # filter_urls skips pages already in the collection, attempted also skips pages
+    # that failed on an earlier run. Stored pages are only tagged for the pack.
+    attempted = set(checkpoint["attempted"])
+    new_urls = filter_urls(checkpoint["pending"])
+    page_meta = None
+    if args.emergency_type:
+        page_meta = {"emergency_type": args.emergency_type}
+        new = set(new_urls)
+        stored = [url for url in checkpoint["pending"] if url not in new]
+        tagged = tag_documents(stored, page_meta)
+        logging.info(f"Tagged {len(tagged)} stored pages as {args.emergency_type}")
+    urls = [url for url in new_urls if url not in attempted]
+    total = 0
+    for start in range(0, len(urls), args.round_size):
+        round_urls = urls[start : start + args.round_size]
+        try:
+            ids = ingest_urls(
+                round_urls,
+                timeout=args.round_timeout,
+                buffer_size=args.parallel,
+                batch_size=args.batch_size,
+                page_meta=page_meta,
+            )
+        except TimeoutError:
+            # Stored pages are in the URL index, the rest are retried next run
+            logging.warning(f"Round timed out after {args.round_timeout}s")
+            continue
+        total += len(ids)
+        checkpoint["attempted"].extend(round_urls)
+        write_json(checkpoint_path, checkpoint)
+        logging.info(
+            f"Ingested {start + len(round_urls)}/{len(urls)} URLs, {total} chunks"
+        )
+    return total
+
+
+def build_pack(emergency_type, queries, rerank_timeout):
+    # Lists the type as a pack, so the server searches its pages on their own, and
+    # stores the top references of its common queries for in-memory lookups. A
+    # query whose rerank fell back is left out and computed again on the next run.
+    precomputed = {}
+    for query in queries:
+        skipped = []
+        references = retrieve_and_rerank(
+            query,
+            query,
+            timeout=rerank_timeout,
+            skipped=skipped,
+            emergency_type=emergency_type,
+        )
+        if skipped:
+            logging.warning(f"Rerank fell back, not precomputed: {query!r}")
+            continue
+        precomputed[pack_key(query)] = references
+        logging.info(f"Precomputed {len(references)} references: {query!r}")
+    with edit_knowledge_packs() as packs:
+        packs.setdefault(emergency_type, {}).update(precomputed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-load the Chroma collection")
+    parser.add_argument("--queries", help="file with one seed search query per line")
+    parser.add_argument("--urls", help="file with one seed URL per line")
+    parser.add_argument("--checkpoint", default=INGEST_CHECKPOINT)
+    parser.add_argument("--round-size", type=int, default=200)
+    parser.add_argument("--round-timeout", type=float, default=None)
+    parser.add_argument("--parallel", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore an existing checkpoint"
+    )
+    parser.add_argument("--emergency-type", help="knowledge pack to add pages to")
+    parser.add_argument(
+        "--pack-queries", help="file with one common query per line to precompute"
+    )
+    parser.add_argument("--rerank-timeout", type=float, default=30)
+    args = parser.parse_args()
+    if args.queries is None and args.urls is None and args.pack_queries is None:
+        parser.error("at least one of --queries, --urls or --pack-queries is required")
+    if args.pack_queries is not None and not args.emergency_type:
+        parser.error("--pack-queries requires --emergency-type")
+
+    if args.restart:
+        checkpoint = new_checkpoint()
+    else:
+        checkpoint = load_checkpoint(args.checkpoint)
+    # Seed URLs go through the same pending list as search results
+    known = set(checkpoint["pending"])
+    checkpoint["pending"].extend(
+        url for url in read_lines(args.urls) if url not in known
+    )
+
+    search_seeds(read_lines(args.queries), checkpoint, args.checkpoint)
+    crawler_service.max_pages = args.parallel
+    total = crawl_pending(checkpoint, args.checkpoint, args)
+    logging.info(f"Ingestion finished, {total} chunks stored")
+    if args.emergency_type:
+        pack_queries = read_lines(args.pack_queries)
+        build_pack(args.emergency_type, pack_queries, args.rerank_timeout)
+
+
+if __name__ == "__main__":
+    main()
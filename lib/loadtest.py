@@ -0,0 +1,247 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+# Load test: serves stub Gemini/CSE/Cohere APIs (loadtest_stubs.py), then starts the
+# Flask app and the ASGI app against them in turn and sends the same text-only
+# requests at a fixed concurrency. Queries are unique so the response cache never
+# answers. Run with:
+#   python lib/loadtest.py --requests 400 --concurrency 64 --latency 0.2
+
+LIB_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVERS = {
+    "flask": [
+        sys.executable,
+        "-c",
+        "import sys, main; main.app.run(port=int(sys.argv[1]), threaded=True)",
+        "{port}",
+    ],
+    "asgi": [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "asgi:app",
+        "--port",
+        "{port}",
+        "--log-level",
+        "warning",
+    ],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url, process, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} was not ready after {timeout}s")
+
+
+def start(command, port, env, log):
+    command = [part.format(port=port) for part in command]
+    return subprocess.Popen(
+        command, cwd=LIB_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def server_env(stub_url, work_dir, args):
+    # Fresh stores per server, every rate limit off and a deadline the stubs never hit
+    env = dict(os.environ)
+    env.update(
+        {
+            "GEMINI_API_KEY": "stub",
+            "GEMINI_MODEL_ID": "gemini-stub",
+            "GEMINI_BASE_URL": stub_url,
+            "GOOGLE_API_KEY": "stub",
+            "CSE_ID": "stub",
+            "CSE_BASE_URL": stub_url + "/",
+            "COHERE_API_KEY": "stub",
+            "COHERE_BASE_URL": stub_url,
+            "CHROMA_PERSIST_DIRECTORY": os.path.join(work_dir, "chroma"),
+            "COLLECTION_NAME": "loadtest",
+            "EMBEDDING_CACHE_DIR": os.path.join(work_dir, "embeddings"),
+            "TRANSCRIPT_CACHE_PATH": os.path.join(work_dir, "transcripts.sqlite3"),
+            "KNOWLEDGE_PACK_PATH": os.path.join(work_dir, "knowledge_packs.json"),
+            "CSE_RATE_LIMIT": "0",
+            "GEMINI_RATE_LIMIT": "0",
+            "COHERE_RATE_LIMIT": "0",
+            "REQUEST_DEADLINE": "120",
+            "WEB_RETRIEVAL": "true" if args.web_retrieval else "false",
+            "RECRAWL_INTERVAL": "0",
+            "PREWARM": "false",
+        }
+    )
+    return env
+
+
+def payload(run_id, i, stream):
+    query = f"there is smoke in the hallway, what should I do ({run_id}-{i})"
+    history = [{"role": "user", "text": query}]
+    data = {
+        "query": query,
+        "emergency_type": "fire",
+        "chat_history": json.dumps(history),
+    }
+    if stream:
+        data["stream"] = "true"
+    return data
+
+
+async def send(client, url, data, stream):
+    start = time.perf_counter()
+    if stream:
+        async with client.stream("POST", url, json=data) as response:
+            async for _ in response.aiter_lines():
+                pass
+    else:
+        response = await client.post(url, json=data)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def run_load(url, total, concurrency, stream, run_id):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async def one(i):
+        async with semaphore:
+            try:
+                latencies.append(
+                    await send(client, url, payload(run_id, i, stream), stream)
+                )
+            except Exception as e:
+                errors.append(repr(e))
+
+    async with httpx.AsyncClient(limits=limits, timeout=300) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def report(name, latencies, errors, elapsed):
+    print(
+        f"{name:>6}: {len(latencies) / elapsed:7.1f} req/s, "
+        f"p50 {percentile(latencies, 0.5) * 1000:7.1f}ms, "
+        f"p95 {percentile(latencies, 0.95) * 1000:7.1f}ms, "
+        f"max {max(latencies, default=float('nan')) * 1000:7.1f}ms, "
+        f"{len(errors)} errors"
+    )
+    for error in sorted(set(errors))[:5]:
+        print(f"        {error}")
+
+
+def bench(name, stub_url, args):
+    work_dir = tempfile.mkdtemp(prefix=f"loadtest-{name}-")
+    port = free_port()
+    log_path = os.path.join(work_dir, "server.log")
+    with open(log_path, "w") as log:
+        process = start(SERVERS[name], port, server_env(stub_url, work_dir, args), log)
+        try:
+            base = f"http://127.0.0.1:{port}"
+            wait_ready(base + "/readyz", process)
+            url = base + "/"
+            run_id = uuid.uuid4().hex[:8]
+            asyncio.run(
+                run_load(url, args.warmup, args.concurrency, args.stream, run_id + "w")
+            )
+            results = asyncio.run(
+                run_load(url, args.requests, args.concurrency, args.stream, run_id)
+            )
+        finally:
+            stop(process)
+    report(name, *results)
+    if results[1]:
+        print(f"        server log: {log_path}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the Flask and ASGI servers against stub APIs"
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="seconds per stub API call"
+    )
+    parser.add_argument("--stream", action="store_true", help="stream the answers")
+    parser.add_argument(
+        "--web-retrieval",
+        action="store_true",
+        help="search, crawl and rerank too (needs crawl4ai and the embedding model)",
+    )
+    parser.add_argument(
+        "--servers", default="flask,asgi", help="comma-separated, flask and/or asgi"
+    )
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    stubs = subprocess.Popen(
+        [
+            sys.executable,
+            "loadtest_stubs.py",
+            "--port",
+            str(stub_port),
+            "--latency",
+            str(args.latency),
+        ],
+        cwd=LIB_DIR,
+    )
+    try:
+        wait_ready(stub_url + "/customsearch/v1", stubs)
+        print(
+            f"{args.requests} requests, concurrency {args.concurrency}, "
+            f"{args.latency}s per API call"
+        )
+        for name in args.servers.split(","):
+            bench(name.strip(), stub_url, args)
+    finally:
+        stop(stubs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import json
+import os
+import uuid
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# Local stand-ins for Gemini, Custom Search and Cohere with a fixed latency per call,
+# so loadtest.py measures the servers and not the APIs. Only the fields main.py reads
+# are filled in. Run on its own with:
+#   python lib/loadtest_stubs.py --port 8900 --latency 0.2
+
+LATENCY = float(os.getenv("STUB_LATENCY", "0.2"))
+STREAM_CHUNKS = 5
+ANSWER = (
+    "Move to a safe place, call your local emergency number and stay on the line. "
+    "Keep your phone charged and follow instructions from the authorities."
+)
+
+
+def usage(prompt_tokens, answer):
+    candidates_tokens = len(answer) // 4 + 1
+    return {
+        "promptTokenCount": prompt_tokens,
+        "candidatesTokenCount": candidates_tokens,
+        "totalTokenCount": prompt_tokens + candidates_tokens,
+    }
+
+
+def candidate(text):
+    return {
+        "content": {"role": "model", "parts": [{"text": text}]},
+        "finishReason": "STOP",
+    }
+
+
+def last_user_text(body):
+    for content in reversed(body.get("contents", [])):
+        for part in content.get("parts", []):
+            if "text" in part:
+                return part["text"]
+    return ""
+
+
+async def gemini(request):
+    # /v1beta/models/{model}:generateContent and :streamGenerateContent
+    body = await request.json()
+    method = request.path_params["call"].rpartition(":")[2]
+    await asyncio.sleep(LATENCY)
+    prompt_tokens = len(json.dumps(body)) // 4 + 1
+    config = body.get("generationConfig", {})
+    if config.get("responseMimeType") == "application/json":
+        keyword = " ".join(last_user_text(body).split()[:4]) or "null"
+        text = json.dumps({"search_keyword": keyword, "reranker_query": keyword})
+    else:
+        text = ANSWER
+    if method == "generateContent":
+        return JSONResponse(
+            {
+                "candidates": [candidate(text)],
+                "usageMetadata": usage(prompt_tokens, text),
+            }
+        )
+
+    async def chunks():
+        step = len(text) // STREAM_CHUNKS + 1
+        for start in range(0, len(text), step):
+            chunk = {"candidates": [candidate(text[start : start + step])]}
+            if start + step >= len(text):
+                chunk["usageMetadata"] = usage(prompt_tokens, text)
+            yield f"data: {json.dumps(chunk)}\r\n\r\n"
+            await asyncio.sleep(LATENCY / STREAM_CHUNKS)
+
+    return StreamingResponse(chunks(), media_type="text/event-stream")
+
+
+async def rerank(request):
+    body = await request.json()
+    await asyncio.sleep(LATENCY)
+    top_n = min(body.get("top_n") or len(body["documents"]), len(body["documents"]))
+    results = [
+        {"index": i, "relevance_score": 1.0 - i / (top_n + 1)} for i in range(top_n)
+    ]
+    return JSONResponse(
+        {
+            "id": str(uuid.uuid4()),
+            "results": results,
+            "meta": {"api_version": {"version": "1"}},
+        }
+    )
+
+
+async def custom_search(request):
+    await asyncio.sleep(LATENCY)
+    start = int(request.query_params.get("start", "1"))
+    base = str(request.base_url)
+    items = [{"link": f"{base}pages/{start + i}"} for i in range(10)]
+    return JSONResponse({"items": items})
+
+
+async def page(request):
+    # Crawl targets for --web-retrieval runs, the same small page for every URL
+    await asyncio.sleep(LATENCY)
+    n = request.path_params["n"]
+    html = (
+        f"<html><head><title>Page {n}</title></head><body><h1>Safety page {n}</h1>"
+        f"<p>{ANSWER}</p></body></html>"
+    )
+    return Response(html, media_type="text/html")
+
+
+app = Starlette(
+    routes=[
+        Route("/v1beta/models/{call}", gemini, methods=["POST"]),
+        Route("/v1/rerank", rerank, methods=["POST"]),
+        Route("/customsearch/v1", custom_search, methods=["GET"]),
+        Route("/pages/{n}", page, methods=["GET", "HEAD"]),
+    ]
+)
+
+
+def main():
+    global LATENCY
+    parser = argparse.ArgumentParser(description="Serve stub Gemini/CSE/Cohere APIs")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=LATENCY)
+    args = parser.parse_args()
+    LATENCY = args.latency
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,49 @@
 import uuid
 import logging
-from googleapiclient.discovery import build
+import threading
+import time
+import atexit
+import fcntl
+import itertools
+import queue
+import random
+from contextlib import closing, contextmanager
+from collections import OrderedDict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
 import cohere
+import httpx
 from flask import Flask, request, Response
+from werkzeug.exceptions import (
+    GatewayTimeout,
+    RequestEntityTooLarge,
+    UnprocessableEntity,
+)
 import chromadb
-from crawl4ai import *
+from chromadb.api.types import EmbeddingFunction
+from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
 import asyncio
 import datetime
-import google.generativeai as genai
 import json
 import re
-from html import unescape
+import hashlib
+import tempfile
+import sqlite3
+import urllib.error
+import urllib.request
+from html_text import clean_html
+import numpy as np
+
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:
+    CrossEncoder = None
 from google import genai
-from google.genai.types import GenerateContentConfig, Part, Content
+from google.genai.types import GenerateContentConfig, HttpOptions, Part, Content
 import os
 from dotenv import load_dotenv
 
@@ -21,10 +52,58 @@ load_dotenv()
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
-crawler_config = CrawlerRunConfig(
+# Warm crawlers kept by the crawler service, pages allowed in flight and per-URL timeout
+CRAWLER_POOL_SIZE = int(os.getenv("CRAWLER_POOL_SIZE", "2"))
+CRAWLER_MAX_PAGES = int(os.getenv("CRAWLER_MAX_PAGES", "8"))
+CRAWLER_PAGE_TIMEOUT = float(os.getenv("CRAWLER_PAGE_TIMEOUT", "20"))
+# How often a caller waiting on crawl results checks that the crawls are still alive
+CRAWL_POLL_INTERVAL = 0.5
+# Crawled pages allowed to wait between ingestion stages, and Chroma micro-batch limits
+INGEST_BUFFER_SIZE = int(os.getenv("INGEST_BUFFER_SIZE", "16"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "32"))
+INGEST_BATCH_CHARS = int(os.getenv("INGEST_BATCH_CHARS", "2000000"))
+# How often a stage worker blocked on a full queue checks that its consumer is there
+STAGE_POLL_INTERVAL = 0.5
+# Chunk size and overlap in whitespace-separated tokens, and Chroma rows per add or
+# get call
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "200"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "40"))
+CHROMA_ADD_BATCH = 1000
+# Background recrawl: seconds between runs (0 disables it), pages older than
+# RECRAWL_MAX_AGE seconds are refreshed, at most RECRAWL_BUDGET per run
+RECRAWL_INTERVAL = int(os.getenv("RECRAWL_INTERVAL", "0"))
+RECRAWL_MAX_AGE = int(os.getenv("RECRAWL_MAX_AGE", str(7 * 24 * 3600)))
+RECRAWL_BUDGET = int(os.getenv("RECRAWL_BUDGET", "50"))
+RECRAWL_TIMEOUT = float(os.getenv("RECRAWL_TIMEOUT", "10"))
+# Hybrid retrieval: dense and BM25 hits fused by reciprocal rank, then only
+# candidates within RERANK_CUT_RATIO of the best fused score go to the reranker
+HYBRID_DENSE_K = int(os.getenv("HYBRID_DENSE_K", "50"))
+HYBRID_SPARSE_K = int(os.getenv("HYBRID_SPARSE_K", "50"))
+RRF_K = 60
+RERANK_MIN_CANDIDATES = int(os.getenv("RERANK_MIN_CANDIDATES", "10"))
+RERANK_MAX_CANDIDATES = int(os.getenv("RERANK_MAX_CANDIDATES", "25"))
+RERANK_CUT_RATIO = float(os.getenv("RERANK_CUT_RATIO", "0.5"))
+RERANK_TOP_N = 10
+# Cohere gets this long before the local fallback reranks instead
+RERANK_TIMEOUT = float(os.getenv("RERANK_TIMEOUT", "3"))
+# outbound() already retries, so the Cohere SDK must not retry underneath it
+COHERE_REQUEST_OPTIONS = {"max_retries": 0}
+LOCAL_RERANK_MODEL = os.getenv(
+    "LOCAL_RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2"
+)
+# Per-page metadata copied onto every chunk and kept in the URL index
+PAGE_META_KEYS = ("content_hash", "etag", "last_modified", "emergency_type")
+# Knowledge packs: curated pages tagged with an emergency_type, searched on their own
+# for that type. Top references for common queries are precomputed into
+# KNOWLEDGE_PACK_PATH by ingest.py, live lookups are kept for REFERENCE_CACHE_TTL.
+KNOWLEDGE_PACK_PATH = os.getenv("KNOWLEDGE_PACK_PATH", "knowledge_packs.json")
+REFERENCE_CACHE_SIZE = int(os.getenv("REFERENCE_CACHE_SIZE", "1024"))
+REFERENCE_CACHE_TTL = int(os.getenv("REFERENCE_CACHE_TTL", "3600"))
+CRAWLER_RUN_OPTIONS = dict(
     only_text=True,
     excluded_tags=["form", "header", "footer"],
     keep_data_attributes=False,
+    page_timeout=int(CRAWLER_PAGE_TIMEOUT * 1000),
 )
 
 # Configuration Variables
@@ -33,30 +112,911 @@ CSE_ID = os.getenv("CSE_ID")
 CHROMA_PERSIST_DIRECTORY = os.getenv("CHROMA_PERSIST_DIRECTORY")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME")
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
-GEMINI_CONFIG = GenerateContentConfig(response_modalities=["TEXT"])
+# Alternative API endpoints, unset in production; loadtest.py points them at stubs
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")
+COHERE_BASE_URL = os.getenv("COHERE_BASE_URL")
+CSE_BASE_URL = os.getenv("CSE_BASE_URL")
+# Model configs are built once per stage and never mutated, calls that need a
+# request-specific system instruction work on a copy (see with_instruction)
+ANSWER_CONFIG = GenerateContentConfig(response_modalities=["TEXT"])
+# CSE returns at most 10 results per page, 5 pages are fetched concurrently
+SEARCH_PAGES = 5
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "3600"))
+# Texts per embedding call, embedding threads, and where vectors are cached on disk
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "2"))
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "embedding_cache")
+# Semantic response cache: capacity, entry lifetime, cosine similarity needed for a hit
+# and how many trailing chat messages make up the history fingerprint
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "1800"))
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.92"))
+RESPONSE_CACHE_HISTORY = int(os.getenv("RESPONSE_CACHE_HISTORY", "4"))
+# Web search/crawl/rerank for references, off until the corpus is ready to be used
+WEB_RETRIEVAL = os.getenv("WEB_RETRIEVAL", "false").lower() == "true"
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "16"))
+# Threads fetching CSE result pages, shared by every request (Flask and ASGI): enough
+# for each pipeline worker to have all of its pages in flight at once
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", str(PIPELINE_WORKERS * SEARCH_PAGES)))
+# Largest accepted upload, and the size above which media goes through the Gemini
+# Files API instead of being sent inline with every call
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(50 * 1024 * 1024)))
+MEDIA_INLINE_MAX_BYTES = int(os.getenv("MEDIA_INLINE_MAX_BYTES", str(8 * 1024 * 1024)))
+MEDIA_CHUNK_SIZE = 1024 * 1024
+# Transcripts keyed by media content hash, trimmed least recently used first
+TRANSCRIPT_CACHE_PATH = os.getenv("TRANSCRIPT_CACHE_PATH", "transcripts.sqlite3")
+TRANSCRIPT_CACHE_MAX_BYTES = int(
+    os.getenv("TRANSCRIPT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+)
+# BM25 index (SQLite FTS5) over the stored chunks, next to the collection. Query
+# terms in more than BM25_MAX_DOC_FRACTION of the chunks are not searched.
+BM25_INDEX_PATH = os.getenv(
+    "BM25_INDEX_PATH", os.path.join(CHROMA_PERSIST_DIRECTORY or "", "bm25.sqlite3")
+)
+BM25_MAX_DOC_FRACTION = float(os.getenv("BM25_MAX_DOC_FRACTION", "0.5"))
+# Seconds between checks for chunks other processes added to or removed from the
+# collection; the URL index is rebuilt when there are any
+INDEX_SYNC_INTERVAL = float(os.getenv("INDEX_SYNC_INTERVAL", "30"))
+# Total latency budget per request and the most each stage may take of it. Stages
+# that overrun are dropped and the answer is generated without them; the answer
+# itself always keeps ANSWER_RESERVE seconds.
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "30"))
+ANSWER_RESERVE = float(os.getenv("ANSWER_RESERVE", "10"))
+STAGE_BUDGETS = {
+    "transcription": float(os.getenv("TRANSCRIPTION_BUDGET", "12")),
+    "keywords": float(os.getenv("KEYWORDS_BUDGET", "6")),
+    "search": float(os.getenv("SEARCH_BUDGET", "3")),
+    "crawl": float(os.getenv("CRAWL_BUDGET", "8")),
+    "rerank": float(os.getenv("RERANK_BUDGET", "4")),
+    "summary": float(os.getenv("SUMMARY_BUDGET", "4")),
+    "upload": float(os.getenv("UPLOAD_BUDGET", "8")),
+}
+STAGE_BUDGETS["references"] = sum(
+    STAGE_BUDGETS[stage] for stage in ("search", "crawl", "rerank")
+)
+STREAM_MIMETYPES = {"sse": "text/event-stream", "ndjson": "application/x-ndjson"}
+# Chat history sent to the model: estimated token budget, how many trailing messages
+# always stay verbatim, how many messages a rolling summary advances at a time and
+# how long the summary may get. Summaries are cached per session.
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+HISTORY_MIN_RECENT = int(os.getenv("HISTORY_MIN_RECENT", "4"))
+HISTORY_SUMMARY_STEP = int(os.getenv("HISTORY_SUMMARY_STEP", "6"))
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "400"))
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "1024"))
+SUMMARY_CACHE_TTL = int(os.getenv("SUMMARY_CACHE_TTL", str(24 * 3600)))
+# Outbound API calls: requests per second allowed per API key (0 turns the limit
+# off), retry attempts with jittered exponential backoff, and keep-alive pool size
+RATE_LIMITS = {
+    "cse": float(os.getenv("CSE_RATE_LIMIT", "10")),
+    "gemini": float(os.getenv("GEMINI_RATE_LIMIT", "20")),
+    "cohere": float(os.getenv("COHERE_RATE_LIMIT", "10")),
+}
+OUTBOUND_RETRIES = int(os.getenv("OUTBOUND_RETRIES", "3"))
+OUTBOUND_RETRY_BASE = float(os.getenv("OUTBOUND_RETRY_BASE", "0.5"))
+OUTBOUND_RETRY_MAX = float(os.getenv("OUTBOUND_RETRY_MAX", "8"))
+OUTBOUND_POOL_SIZE = int(os.getenv("OUTBOUND_POOL_SIZE", "20"))
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# Service handles are built on first use. Startup only loads what text-only requests
+# need plus the browsers when something will crawl, and Chroma and Cohere once the
+# knowledge packs turn out to be non-empty; PREWARM also loads the rest of the
+# retrieval stack in the background. /readyz waits for READY_SERVICES only, the
+# response cache only embeds queries once the embedding model has loaded.
+PREWARM = os.getenv("PREWARM", "false").lower() == "true"
+# A service whose warm-up failed is not tried again for WARMUP_RETRY_BASE seconds,
+# doubling with every further failure up to WARMUP_RETRY_MAX
+WARMUP_RETRY_BASE = float(os.getenv("WARMUP_RETRY_BASE", "30"))
+WARMUP_RETRY_MAX = float(os.getenv("WARMUP_RETRY_MAX", "600"))
+READY_SERVICES = ("gemini", "packs")
+STARTUP_SERVICES = (
+    READY_SERVICES
+    + ("embeddings",)
+    + (("crawler",) if WEB_RETRIEVAL or RECRAWL_INTERVAL > 0 else ())
+)
+PREWARM_SERVICES = (
+    "gemini",
+    "packs",
+    "embeddings",
+    "chroma",
+    "cohere",
+    "cross_encoder",
+    "crawler",
+)
 
 # Initialize Flask App
 app = Flask(__name__)
+# Leave room for the form fields around the media part
+app.config["MAX_CONTENT_LENGTH"] = MEDIA_MAX_BYTES + 1024 * 1024
+pipeline_executor = ThreadPoolExecutor(
+    max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline"
+)
+# Separate from the pipeline executor, which runs the stages waiting on them
+rerank_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rerank")
+budget_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="budget")
+# Recrawl validation probes, kept off the pipeline executor so a batch of slow HEAD
+# requests never queues ahead of request stages
+recrawl_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="recrawl")
 # Initialize Google CSE and Gemini
-service = build("customsearch", "v1", developerKey=GOOGLE_API_KEY)
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+# httplib2 connections are not thread-safe, so each search thread builds its own service
+search_local = threading.local()
+search_executor = ThreadPoolExecutor(
+    max_workers=SEARCH_WORKERS, thread_name_prefix="search"
+)
 model_id = os.getenv("GEMINI_MODEL_ID")
 
-# Initialize ChromaDB
-chroma_client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIRECTORY)
 
-# Try to get collection if it exists, or create it
-try:
-    collection = chroma_client.get_collection(name=COLLECTION_NAME)
-    logging.info(f"Using existing collection: {COLLECTION_NAME}")
-except Exception:
-    collection = chroma_client.create_collection(
-        name=COLLECTION_NAME, metadata={"description": "Emergency information database"}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(2**power for power in range(10, 27, 2))
+
+
+class Metrics:
+    # Process-wide counters and histograms rendered in the Prometheus text format
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    "buckets": buckets,
+                    "counts": [0] * len(buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = f"{self.prefix}_{name}_total"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric}{self._labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                metric = f"{self.prefix}_{name}"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} histogram")
+                for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                    bucket_labels = self._labels(labels, [("le", bound)])
+                    lines.append(f"{metric}_bucket{bucket_labels} {count}")
+                inf_labels = self._labels(labels, [("le", "+Inf")])
+                lines.append(f"{metric}_bucket{inf_labels} {histogram['count']}")
+                lines.append(f"{metric}_sum{self._labels(labels)} {histogram['sum']}")
+                lines.append(
+                    f"{metric}_count{self._labels(labels)} {histogram['count']}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics("sos")
+
+
+def record_cache(cache, hit, count=1):
+    metrics.inc("cache_requests", count, cache=cache, result="hit" if hit else "miss")
+
+
+def record_usage(stage, response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    metrics.inc("tokens", usage.prompt_token_count or 0, stage=stage, kind="prompt")
+    metrics.inc("tokens", usage.candidates_token_count or 0, stage=stage, kind="output")
+
+
+class LazyService:
+    # Memoized service handle, built by factory on the first get() and shared by
+    # every thread after that
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.ready = False
+        self._value = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self.ready:
+            return self._value
+        with self._lock:
+            if not self.ready:
+                start = time.perf_counter()
+                self._value = self.factory()
+                self.ready = True
+                seconds = time.perf_counter() - start
+                metrics.observe("startup_seconds", seconds, service=self.name)
+                logging.info(f"Loaded {self.name} in {seconds:.2f}s")
+        return self._value
+
+
+class TokenBucket:
+    # Refills rate tokens per second up to burst. A caller takes a token right away
+    # and sleeps off any debt, so waiters are served in arrival order.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # Seconds the caller has to wait before its request may go out
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            return max(-self.tokens / self.rate, 0.0)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class SingleFlight:
+    # Identical calls made while one is already running wait for its result instead
+    # of going out again
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            metrics.inc("coalesced_calls", service=key[0])
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+single_flight = SingleFlight()
+
+
+def rate_limiter(service):
+    # One bucket per service and API key
+    api_key = {"cse": GOOGLE_API_KEY, "cohere": COHERE_API_KEY}.get(
+        service, os.getenv("GEMINI_API_KEY")
     )
-    logging.info(f"Created new collection: {COLLECTION_NAME}")
+    with rate_limiters_lock:
+        bucket = rate_limiters.get((service, api_key))
+        if bucket is None:
+            rate = RATE_LIMITS[service]
+            bucket = rate_limiters[(service, api_key)] = TokenBucket(rate, max(rate, 1))
+        return bucket
+
+
+def error_status(e):
+    # Cohere errors carry status_code, google-genai errors code, and
+    # googleapiclient's HttpError the response status
+    for attr in ("status_code", "code"):
+        status = getattr(e, attr, None)
+        if isinstance(status, int):
+            return status
+    return getattr(getattr(e, "resp", None), "status", None)
 
-# Initialize Cohere client
-co = cohere.Client(COHERE_API_KEY)
+
+def retryable(e):
+    status = error_status(e)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    return isinstance(e, (OSError, httpx.TransportError))
+
+
+def retry_delay(attempt):
+    # Full jitter keeps clients that failed together from retrying together
+    return random.uniform(0, min(OUTBOUND_RETRY_MAX, OUTBOUND_RETRY_BASE * 2**attempt))
+
+
+def call_with_retry(service, fn, args, kwargs, deadline=None):
+    for attempt in range(OUTBOUND_RETRIES + 1):
+        waited = rate_limiter(service).acquire()
+        if waited:
+            metrics.observe("rate_limit_wait_seconds", waited, service=service)
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            delay = retry_delay(attempt)
+            # No retry once it could not start before the deadline
+            out_of_time = deadline is not None and delay >= deadline.remaining()
+            if attempt == OUTBOUND_RETRIES or not retryable(e) or out_of_time:
+                metrics.inc("outbound_errors", service=service)
+                raise
+            metrics.inc("outbound_retries", service=service)
+            logging.warning(f"{service} call failed ({e!r}), retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+
+def outbound(service, fn, *args, flight_key=None, deadline=None, **kwargs):
+    # Shared path for CSE, Gemini and Cohere calls: rate limited per API key and
+    # retried on 429/5xx and connection errors, but not past deadline. Calls with
+    # the same flight_key share one in-flight request.
+    if flight_key is None:
+        return call_with_retry(service, fn, args, kwargs, deadline)
+    return single_flight.do(
+        (service, flight_key),
+        lambda: call_with_retry(service, fn, args, kwargs, deadline),
+    )
+
+
+# Cache keys are sha256 hex digests
+KEY_LENGTH = 64
+
+
+class CachedEmbeddingFunction(EmbeddingFunction):
+    # Wraps a Chroma embedding function with batching and a content-hash vector cache.
+    # Vectors are appended to a raw float32 file that is read back memory-mapped,
+    # keys.txt holds one content hash per row. Several processes (WSGI workers,
+    # ingest.py) can share cache_dir: appends hold an flock on cache.lock and first
+    # pick up the rows the others wrote.
+    def __init__(self, base, cache_dir, batch_size, workers):
+        self.base = base
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="embed"
+        )
+        os.makedirs(cache_dir, exist_ok=True)
+        self.keys_path = os.path.join(cache_dir, "keys.txt")
+        self.vectors_path = os.path.join(cache_dir, "vectors.f32")
+        self.meta_path = os.path.join(cache_dir, "meta.json")
+        self.lock_path = os.path.join(cache_dir, "cache.lock")
+        self.dim = None
+        self.rows = {}
+        self.row_count = 0
+        self.vectors = None
+        self._lock = threading.Lock()
+        with self._lock, self._file_lock():
+            self._sync()
+        logging.info(f"Loaded {len(self.rows)} cached embeddings")
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _sync(self):
+        # Called under both locks. Every key is a 64 character hash plus newline, so
+        # both files give a row count. A crash mid-append leaves one longer than the
+        # other; both are cut back to the rows they have in common, then the rows
+        # other processes appended since the last sync are read in.
+        if self.dim is None:
+            if not os.path.exists(self.meta_path):
+                return
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)["dim"]
+        key_bytes = KEY_LENGTH + 1
+        for path in (self.keys_path, self.vectors_path):
+            open(path, "ab").close()
+        rows = min(
+            os.path.getsize(self.keys_path) // key_bytes,
+            os.path.getsize(self.vectors_path) // (4 * self.dim),
+        )
+        os.truncate(self.keys_path, rows * key_bytes)
+        os.truncate(self.vectors_path, rows * 4 * self.dim)
+        if rows < self.row_count:
+            # Another process cut back rows this one had read, start over
+            self.rows = {}
+            self.row_count = 0
+        if rows > self.row_count:
+            with open(self.keys_path, "rb") as f:
+                f.seek(self.row_count * key_bytes)
+                keys = f.read((rows - self.row_count) * key_bytes).decode().split()
+            for key in keys:
+                self.rows.setdefault(key, self.row_count)
+                self.row_count += 1
+        self._map()
+
+    def _map(self):
+        self.vectors = None
+        if self.row_count:
+            self.vectors = np.memmap(
+                self.vectors_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(self.row_count, self.dim),
+            )
+
+    def _append(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock, self._file_lock():
+            self._sync()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, "w") as f:
+                    json.dump({"dim": self.dim}, f)
+            new = [i for i, key in enumerate(keys) if key not in self.rows]
+            if not new:
+                return
+            # Vectors first: a crash before the keys are written only leaves rows
+            # that the next sync cuts off
+            with open(self.vectors_path, "ab") as f:
+                f.write(vectors[new].tobytes())
+            with open(self.keys_path, "a") as f:
+                f.writelines(keys[i] + "\n" for i in new)
+            for i in new:
+                self.rows[keys[i]] = self.row_count
+                self.row_count += 1
+            self._map()
+
+    def _lookup(self, key):
+        with self._lock:
+            row = self.rows.get(key)
+            return None if row is None else np.array(self.vectors[row])
+
+    def __call__(self, input):
+        keys = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in input]
+        embeddings = [self._lookup(key) for key in keys]
+        cached = sum(embedding is not None for embedding in embeddings)
+        record_cache("embedding", True, cached)
+        record_cache("embedding", False, len(keys) - cached)
+
+        # Embed each distinct uncached text once, batches run concurrently
+        missing = {}
+        for i, key in enumerate(keys):
+            if embeddings[i] is None:
+                missing.setdefault(key, input[i])
+        if missing:
+            missing_keys = list(missing)
+            batches = [
+                [missing[key] for key in missing_keys[start : start + self.batch_size]]
+                for start in range(0, len(missing_keys), self.batch_size)
+            ]
+            with metrics.time("stage_seconds", stage="embed"):
+                vectors = [
+                    vector
+                    for batch in self.executor.map(self.base, batches)
+                    for vector in batch
+                ]
+            self._append(missing_keys, vectors)
+            computed = dict(zip(missing_keys, vectors))
+            embeddings = [
+                (
+                    np.asarray(computed[key], dtype=np.float32)
+                    if vector is None
+                    else vector
+                )
+                for key, vector in zip(keys, embeddings)
+            ]
+        return embeddings
+
+
+# Batched, disk-cached wrapper around Chroma's default model, so stored vectors stay
+# compatible with the existing collection
+embedding_function = CachedEmbeddingFunction(
+    DefaultEmbeddingFunction(), EMBEDDING_CACHE_DIR, EMBED_BATCH_SIZE, EMBED_WORKERS
+)
+
+
+def open_collection():
+    # Loads the persisted HNSW index, so it only runs once something needs Chroma
+    chroma_client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIRECTORY)
+
+    # Try to get collection if it exists, or create it
+    try:
+        collection = chroma_client.get_collection(
+            name=COLLECTION_NAME, embedding_function=embedding_function
+        )
+        logging.info(f"Using existing collection: {COLLECTION_NAME}")
+    except Exception:
+        collection = chroma_client.create_collection(
+            name=COLLECTION_NAME,
+            metadata={"description": "Emergency information database"},
+            embedding_function=embedding_function,
+        )
+        logging.info(f"Created new collection: {COLLECTION_NAME}")
+    build_indexes(collection)
+    return collection
+
+
+def warm_embeddings():
+    # Loads the embedding model without writing a vector to the cache
+    embedding_function.base(["warm up"])
+
+
+embedding_model = LazyService("embeddings", warm_embeddings)
+gemini = LazyService(
+    "gemini",
+    lambda: genai.Client(
+        api_key=os.getenv("GEMINI_API_KEY"),
+        http_options={"base_url": GEMINI_BASE_URL} if GEMINI_BASE_URL else None,
+    ),
+)
+chroma = LazyService("chroma", open_collection)
+cohere_service = LazyService(
+    "cohere",
+    lambda: cohere.Client(
+        COHERE_API_KEY,
+        base_url=COHERE_BASE_URL,
+        httpx_client=httpx.Client(
+            limits=httpx.Limits(
+                max_connections=OUTBOUND_POOL_SIZE,
+                max_keepalive_connections=OUTBOUND_POOL_SIZE,
+            ),
+            timeout=RERANK_TIMEOUT * 2,
+        ),
+    ),
+)
+get_client = gemini.get
+get_collection = chroma.get
+get_cohere = cohere_service.get
+
+
+class TTLCache:
+    # Thread-safe LRU cache whose entries also expire after ttl seconds
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard_values(self, predicate):
+        # Drops every entry whose value matches, expired or not
+        with self._lock:
+            for key in [k for k, (v, _) in self._data.items() if predicate(v)]:
+                del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(self.expires - time.monotonic(), 0.0)
+
+    def budget(self, stage):
+        # A stage gets its own budget, but never eats into the answer's reserve
+        return max(min(STAGE_BUDGETS[stage], self.remaining() - ANSWER_RESERVE), 0.0)
+
+
+# Normalized query -> tuple of result URLs
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+# Session key -> (summarized message count, digest of those messages, summary)
+summary_cache = TTLCache(SUMMARY_CACHE_SIZE, SUMMARY_CACHE_TTL)
+
+
+class SemanticCache:
+    # LRU/TTL cache of final answers. Within a bucket (emergency type + history
+    # fingerprint) a query hits when its embedding is close enough to a cached one.
+    # Until ready() is true, or when embedding fails, answers are stored without a
+    # vector and only hit on exact repeats.
+    def __init__(self, embed, maxsize, ttl, threshold, ready=lambda: True):
+        self.embed = embed
+        self.ready = ready
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        # (bucket, normalized query) -> (unit vector or None, response, expires)
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _vector(self, query):
+        # The cache fails open: without an embedding only exact repeats can hit
+        if not self.ready():
+            return None
+        try:
+            vector = np.asarray(self.embed([query])[0], dtype=np.float32)
+        except Exception as e:
+            logging.warning(f"Response cache embedding failed: {e!r}")
+            metrics.inc("cache_errors", cache="response")
+            return None
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _remove(self, key):
+        del self._entries[key]
+        keys = self._buckets[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._buckets[key[0]]
+
+    def _match(self, bucket, query, vector):
+        now = time.monotonic()
+        key = (bucket, query)
+        if key not in self._entries and vector is not None:
+            best_score = self.threshold
+            for candidate in self._buckets.get(bucket, ()):
+                candidate_vector = self._entries[candidate][0]
+                if candidate_vector is None:
+                    continue
+                score = float(vector @ candidate_vector)
+                if score >= best_score:
+                    key, best_score = candidate, score
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] < now:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def get(self, bucket, query):
+        query = normalize_query(query)
+        with self._lock:
+            # Exact repeats are answered without embedding the query
+            response = self._match(bucket, query, None)
+        if response is None:
+            vector = self._vector(query)
+            if vector is not None:
+                with self._lock:
+                    response = self._match(bucket, query, vector)
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        record_cache("response", response is not None)
+        return response
+
+    def set(self, bucket, query, response):
+        query = normalize_query(query)
+        vector = self._vector(query)
+        with self._lock:
+            key = (bucket, query)
+            self._entries[key] = (vector, response, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            self._buckets.setdefault(bucket, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+            }
+
+
+# Queries are embedded with the bare model, the disk-backed cache only holds vectors
+# of stored chunks and would otherwise keep every user query forever. The model is
+# loaded by warm-up, never by a request.
+response_cache = SemanticCache(
+    embedding_function.base,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_THRESHOLD,
+    ready=lambda: embedding_model.ready,
+)
+
+
+class TranscriptCache:
+    # Content-addressed transcripts in SQLite. Once the stored text passes max_bytes
+    # the least recently used rows are deleted.
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS transcripts (
+                key TEXT PRIMARY KEY,
+                transcript TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS transcripts_accessed ON transcripts (accessed)"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT transcript FROM transcripts WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE transcripts SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key, transcript):
+        size = len(transcript.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO transcripts VALUES (?, ?, ?, ?)",
+                (key, transcript, size, time.time()),
+            )
+            total = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM transcripts"
+            ).fetchone()[0]
+            if total > self.max_bytes:
+                evicted = []
+                for old_key, old_size in self._conn.execute(
+                    "SELECT key, size FROM transcripts ORDER BY accessed"
+                ):
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append((old_key,))
+                    total -= old_size
+                self._conn.executemany("DELETE FROM transcripts WHERE key = ?", evicted)
+            self._conn.commit()
+
+
+transcript_cache = TranscriptCache(TRANSCRIPT_CACHE_PATH, TRANSCRIPT_CACHE_MAX_BYTES)
+
+
+class BM25Index:
+    # Okapi BM25 over the stored chunks in an SQLite FTS5 table, scored by bm25() in
+    # SQLite instead of walking posting lists in Python under a lock. The table lives
+    # on disk, so every process writing the collection (app workers, ingest.py)
+    # keeps it current. One connection per thread; WAL lets searches run while
+    # another thread or process writes.
+    def __init__(self, path, max_doc_fraction):
+        self.path = path
+        self.max_doc_fraction = max_doc_fraction
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_ids "
+                "(rowid INTEGER PRIMARY KEY, doc_id TEXT UNIQUE NOT NULL)"
+            )
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(text)")
+            # Per-term document counts, read to skip terms below the IDF floor
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS temp.chunk_terms "
+                "USING fts5vocab(main, chunks, 'row')"
+            )
+            self._local.conn = conn
+        return conn
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM chunk_ids").fetchone()[0]
+
+    def add(self, ids, texts):
+        conn = self._conn()
+        with conn:
+            for doc_id, text in zip(ids, texts):
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO chunk_ids (doc_id) VALUES (?)", (doc_id,)
+                )
+                if cursor.rowcount:
+                    conn.execute(
+                        "INSERT INTO chunks (rowid, text) VALUES (?, ?)",
+                        (cursor.lastrowid, text),
+                    )
+
+    def remove(self, ids):
+        conn = self._conn()
+        with conn:
+            for doc_id in ids:
+                row = conn.execute(
+                    "SELECT rowid FROM chunk_ids WHERE doc_id = ?", (doc_id,)
+                ).fetchone()
+                if row:
+                    conn.execute("DELETE FROM chunks WHERE rowid = ?", row)
+                    conn.execute("DELETE FROM chunk_ids WHERE rowid = ?", row)
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM chunks")
+            conn.execute("DELETE FROM chunk_ids")
+
+    def search(self, query, n):
+        # Any query term may match. Terms found in most chunks have an IDF near zero
+        # but make bm25() score nearly every row, so they are dropped.
+        conn = self._conn()
+        count = len(self)
+        terms = []
+        for term in dict.fromkeys(re.findall(r"\w+", query.lower())):
+            row = conn.execute(
+                "SELECT doc FROM temp.chunk_terms WHERE term = ?", (term,)
+            ).fetchone()
+            if row is None or row[0] <= count * self.max_doc_fraction:
+                terms.append(term)
+        if not count or not terms:
+            return []
+        # Quoted so FTS5 query syntax in the user's text is taken literally
+        match = " OR ".join(f'"{term}"' for term in terms)
+        rows = conn.execute(
+            "SELECT chunk_ids.doc_id, bm25(chunks) FROM chunks "
+            "JOIN chunk_ids ON chunk_ids.rowid = chunks.rowid "
+            "WHERE chunks MATCH ? ORDER BY bm25(chunks) LIMIT ?",
+            (match, n),
+        ).fetchall()
+        # bm25() is lower for better matches
+        return [(doc_id, -score) for doc_id, score in rows]
+
+
+bm25_index = BM25Index(BM25_INDEX_PATH, BM25_MAX_DOC_FRACTION)
+
+# URL -> {"ids": [...], "timestamp": ...} index over the stored documents, in this
+# process's memory. index_state holds the chunk count it reflects and when that was
+# last compared with the collection.
+url_index = {}
+url_index_lock = threading.Lock()
+index_state = {"count": 0, "checked": 0.0}
 
 
 def log_exception(f):
@@ -70,109 +1030,871 @@ def log_exception(f):
     return wrapper
 
 
+def get_search_service():
+    if not hasattr(search_local, "service"):
+        from googleapiclient.discovery import build
+
+        search_local.service = build(
+            "customsearch",
+            "v1",
+            developerKey=GOOGLE_API_KEY,
+            cache_discovery=False,
+            client_options={"api_endpoint": CSE_BASE_URL} if CSE_BASE_URL else None,
+        )
+    return search_local.service
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+def fetch_search_page(query, page, cse=None):
+    # Maximum of 10 results per request
+    # Use start to specify the starting index which navigate to next 10 results
+    cse = cse or get_search_service()
+    request = cse.cse().list(q=query, cx=CSE_ID, num=10, start=10 * page + 1)
+    with metrics.time("stage_seconds", stage="cse"):
+        response = outbound(
+            "cse", request.execute, flight_key=(normalize_query(query), page)
+        )
+    return [item.get("link") for item in response.get("items", [])]
+
+
+def collect_search_pages(key, pages):
+    urls = [url for page in pages for url in page]
+    search_cache.set(key, tuple(urls))
+    return urls
+
+
 @log_exception
-def google_search(query):
-    # Build the service
-    urls = []
-    for s in range(5):
-        # Maximum of 10 results per request
-        # Use start to specify the starting index which navigate to next 10 results
-        response = (
-            service.cse().list(q=query, cx=CSE_ID, num=10, start=10 * s + 1).execute()
+def google_search(query, cse=None):
+    # cse can be any object exposing cse().list(...).execute(), e.g. a local stub
+    key = normalize_query(query)
+    cached = search_cache.get(key)
+    record_cache("search", cached is not None)
+    if cached is not None:
+        logging.info(f"Search cache hit: {key}")
+        return list(cached)
+
+    pages = search_executor.map(
+        lambda page: fetch_search_page(query, page, cse), range(SEARCH_PAGES)
+    )
+    return collect_search_pages(key, pages)
+
+
+async def google_search_async(query, cse=None):
+    key = normalize_query(query)
+    cached = search_cache.get(key)
+    record_cache("search", cached is not None)
+    if cached is not None:
+        logging.info(f"Search cache hit: {key}")
+        return list(cached)
+
+    loop = asyncio.get_running_loop()
+    pages = await asyncio.gather(
+        *(
+            loop.run_in_executor(search_executor, fetch_search_page, query, page, cse)
+            for page in range(SEARCH_PAGES)
+        )
+    )
+    return collect_search_pages(key, pages)
+
+
+def index_documents(ids, metadatas, index=None):
+    if index is None:
+        index = url_index
+    with url_index_lock:
+        for doc_id, metadata in zip(ids, metadatas):
+            if not metadata or "url" not in metadata:
+                continue
+            entry = index.setdefault(metadata["url"], {"ids": [], "timestamp": None})
+            entry["ids"].append(doc_id)
+            for key in PAGE_META_KEYS:
+                if key in metadata:
+                    entry[key] = metadata[key]
+            timestamp = metadata.get("timestamp")
+            if timestamp and (
+                entry["timestamp"] is None or timestamp > entry["timestamp"]
+            ):
+                entry["timestamp"] = timestamp
+
+
+def build_indexes(collection, bm25=True):
+    # Scan the collection's metadata when it is opened, afterwards store_chunks keeps
+    # the URL index in sync. The scan fills a new index that replaces the old one in
+    # one step, so lookups never see it half built. The BM25 index is kept on disk
+    # and only rebuilt when it no longer matches the collection (first run, or a
+    # crash between the two writes). Both go page by page instead of loading every
+    # chunk at once.
+    count = collection.count()
+    rebuild = bm25 and len(bm25_index) != count
+    if rebuild:
+        logging.info(f"Rebuilding the BM25 index for {count} chunks")
+        bm25_index.clear()
+    include = ["metadatas", "documents"] if rebuild else ["metadatas"]
+    index = {}
+    for offset in range(0, count, CHROMA_ADD_BATCH):
+        results = collection.get(include=include, limit=CHROMA_ADD_BATCH, offset=offset)
+        index_documents(results["ids"], results["metadatas"], index)
+        if rebuild:
+            bm25_index.add(results["ids"], results["documents"])
+    with url_index_lock:
+        url_index.clear()
+        url_index.update(index)
+        index_state["count"] = count
+        index_state["checked"] = time.monotonic()
+    logging.info(f"Indexed {len(index)} URLs from collection: {COLLECTION_NAME}")
+
+
+def sync_indexes():
+    # App workers and ingest.py write to the same collection, each with a URL index
+    # of its own. At most every INDEX_SYNC_INTERVAL seconds the collection's count is
+    # compared with what this process has indexed, and the URL index is scanned
+    # again when they differ. The BM25 index is on disk and shared already.
+    collection = get_collection()
+    now = time.monotonic()
+    with url_index_lock:
+        if now - index_state["checked"] < INDEX_SYNC_INTERVAL:
+            return collection
+        index_state["checked"] = now
+        count = index_state["count"]
+    if collection.count() != count:
+        logging.info("Collection changed in another process, rebuilding URL index")
+        build_indexes(collection, bm25=False)
+    return collection
+
+
+def touch_documents(urls):
+    # Mark pages as fresh without rewriting their chunks
+    timestamp = datetime.datetime.now().isoformat()
+    with url_index_lock:
+        ids = [
+            doc_id
+            for url in urls
+            if url in url_index
+            for doc_id in url_index[url]["ids"]
+        ]
+    if not ids:
+        return
+    results = get_collection().get(ids=ids, include=["metadatas"])
+    metadatas = [
+        dict(metadata, timestamp=timestamp) for metadata in results["metadatas"]
+    ]
+    get_collection().update(ids=results["ids"], metadatas=metadatas)
+    with url_index_lock:
+        for url in urls:
+            if url in url_index:
+                url_index[url]["timestamp"] = timestamp
+
+
+def tag_documents(urls, meta):
+    # Adds page metadata (a knowledge pack's emergency_type) to pages that are
+    # already stored, without crawling them again. Returns the URLs that changed.
+    collection = sync_indexes()
+    with url_index_lock:
+        urls = [
+            url
+            for url in dict.fromkeys(urls)
+            if url in url_index
+            and any(url_index[url].get(key) != value for key, value in meta.items())
+        ]
+        ids = [doc_id for url in urls for doc_id in url_index[url]["ids"]]
+    for start in range(0, len(ids), CHROMA_ADD_BATCH):
+        results = collection.get(
+            ids=ids[start : start + CHROMA_ADD_BATCH], include=["metadatas"]
         )
-        items = response.get("items", [])
-        urls.extend([item.get("link") for item in items])
+        metadatas = [dict(metadata, **meta) for metadata in results["metadatas"]]
+        collection.update(ids=results["ids"], metadatas=metadatas)
+    with url_index_lock:
+        for url in urls:
+            if url in url_index:
+                url_index[url].update(meta)
     return urls
 
 
 @log_exception
 def filter_urls(urls):
-    # Get all documents with their metadata
-    results = collection.get(include=["metadatas"])
-
-    # Create URL to ID mapping
-    existing_urls = {url: None for url in urls}
+    sync_indexes()
     new_urls = []
-    if results and "ids" in results and "metadatas" in results:
-        for i, metadata in enumerate(results["metadatas"]):
-            if metadata and "url" in metadata:
-                existing_urls[metadata["url"]] = results["ids"][i]
-    for url, id in existing_urls.items():
-        if id is None:
-            new_urls.append(url)
-            logging.info(f"NEW URL:{url}")
+    with url_index_lock:
+        # dict.fromkeys drops duplicates while keeping the search order
+        for url in dict.fromkeys(urls):
+            if url not in url_index:
+                new_urls.append(url)
+                logging.info(f"NEW URL:{url}")
 
     return new_urls
 
 
-def clean_html(html_content):
-    # Remove HTML tags
-    text = re.sub(r"<[^>]+>", "", html_content)
+class CrawlerService:
+    # Long-lived browsers on one background event loop, shared by request threads
+    def __init__(self, pool_size, max_pages, page_timeout):
+        self.pool_size = pool_size
+        self.max_pages = max_pages
+        self.page_timeout = page_timeout
+        self.loop = None
+        self.run_config = None
+        self._thread = None
+        self._crawlers = []
+        self._next_crawler = None
+        self._pages = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._next_crawler is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self.loop.run_forever, name="crawler-loop", daemon=True
+            )
+            self._thread.start()
+            try:
+                asyncio.run_coroutine_threadsafe(
+                    self._start_crawlers(), self.loop
+                ).result()
+            except Exception:
+                # No browsers or no crawl4ai: close what did launch and reset, so
+                # the next start() tries again instead of finding a dead service
+                self._shutdown()
+                raise
+
+    async def _start_crawlers(self):
+        # crawl4ai pulls in Playwright, import it only once browsers are wanted
+        from crawl4ai import AsyncWebCrawler, CrawlerRunConfig
+
+        self.run_config = CrawlerRunConfig(**CRAWLER_RUN_OPTIONS)
+        self._pages = asyncio.Semaphore(self.max_pages)
+        for _ in range(self.pool_size):
+            crawler = AsyncWebCrawler()
+            await crawler.start()
+            self._crawlers.append(crawler)
+        self._next_crawler = itertools.cycle(self._crawlers)
+        logging.info(f"Started {self.pool_size} crawlers")
+
+    async def _close_crawlers(self):
+        for crawler in self._crawlers:
+            try:
+                await crawler.close()
+            except Exception as e:
+                logging.warning(f"Closing a crawler failed: {e!r}")
+        self._crawlers.clear()
+
+    def _shutdown(self):
+        # Called with the lock held
+        asyncio.run_coroutine_threadsafe(self._close_crawlers(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self.loop = None
+        self._thread = None
+        self._next_crawler = None
+        self._pages = None
+
+    async def _crawl_one(self, url):
+        async with self._pages:
+            # A crawler opens a new page per arun, so jobs share crawlers round-robin
+            crawler = next(self._next_crawler)
+            start = time.perf_counter()
+            try:
+                return await asyncio.wait_for(
+                    crawler.arun(url=url, config=self.run_config), self.page_timeout
+                )
+            except asyncio.TimeoutError:
+                logging.warning(f"Crawl timed out after {self.page_timeout}s: {url}")
+            except Exception as e:
+                logging.error(f"An error occurred while crawling {url}: {e}")
+            finally:
+                metrics.observe(
+                    "stage_seconds", time.perf_counter() - start, stage="crawl"
+                )
+            return None
+
+    def iter_crawl(self, urls, buffer_size, timeout=None):
+        # Yields (url, result) as each crawl finishes. A crawl only starts once one of
+        # buffer_size slots is free, and a slot frees up when its result is consumed.
+        # Past timeout seconds the remaining crawls are cancelled with TimeoutError.
+        # The budget covers the crawls, not a first browser launch
+        self.start()
+        expires = None if timeout is None else time.monotonic() + timeout
+        results = queue.Queue()
+        slots = asyncio.Semaphore(buffer_size)
+
+        async def crawl_into_queue(url):
+            await slots.acquire()
+            results.put((url, await self._crawl_one(url)))
+
+        async def produce():
+            await asyncio.gather(*(crawl_into_queue(url) for url in urls))
+
+        future = asyncio.run_coroutine_threadsafe(produce(), self.loop)
+        try:
+            for _ in range(len(urls)):
+                item = self._next_result(results, future, expires, timeout)
+                yield item
+                self.loop.call_soon_threadsafe(slots.release)
+            future.result()
+        finally:
+            future.cancel()
+
+    @staticmethod
+    def _next_result(results, future, expires, timeout):
+        # Waits in short steps so a producer that died raises here instead of
+        # leaving the caller blocked on a queue nothing will fill
+        while True:
+            wait = CRAWL_POLL_INTERVAL
+            if expires is not None:
+                wait = min(wait, max(expires - time.monotonic(), 0.0))
+            try:
+                return results.get(timeout=wait)
+            except queue.Empty:
+                pass
+            if future.done() and results.empty():
+                future.result()
+                raise RuntimeError("Crawl producer stopped before every URL")
+            if expires is not None and time.monotonic() >= expires:
+                raise TimeoutError(f"Crawl exceeded {timeout:.1f}s")
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._shutdown()
+
+
+crawler_service = CrawlerService(
+    CRAWLER_POOL_SIZE, CRAWLER_MAX_PAGES, CRAWLER_PAGE_TIMEOUT
+)
+atexit.register(crawler_service.stop)
+
+
+def clean_crawl_result(item):
+    # Keyed by the requested URL so redirects still match the URL index
+    url, res = item
+    if res is not None and res.success:
+        print(res.url, "crawled OK!")
+        with metrics.time("stage_seconds", stage="clean_html"):
+            return url, clean_html(res.cleaned_html)
+    print("Failed:", url, "-", res.error_message if res else "no result")
+    metrics.inc("crawl_failures")
+    return url, None
+
+
+def run_stage(items, fn, maxsize):
+    # Apply fn to items on a worker thread, handing results over a bounded queue.
+    # When the consumer stops early (closes the generator) the worker stops as well
+    # and closes items, so an iter_crawl source cancels its crawls.
+    results = queue.Queue(maxsize=maxsize)
+    done = object()
+    stopped = threading.Event()
+
+    def put(entry):
+        # False once nobody will take the entry
+        while not stopped.is_set():
+            try:
+                results.put(entry, timeout=STAGE_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work():
+        try:
+            for item in items:
+                if not put((fn(item), None)):
+                    return
+        except Exception as e:
+            put((None, e))
+            return
+        finally:
+            if stopped.is_set() and hasattr(items, "close"):
+                items.close()
+        put((done, None))
+
+    threading.Thread(target=work, name=f"stage-{fn.__name__}", daemon=True).start()
+    try:
+        while True:
+            result, error = results.get()
+            if error is not None:
+                raise error
+            if result is done:
+                return
+            yield result
+    finally:
+        stopped.set()
+
+
+def chunk_text(text, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP):
+    # Cleaned text is single-space separated, so words stand in for tokens
+    words = text.split()
+    if not words:
+        return []
+    step = max(max_tokens - overlap, 1)
+    return [
+        " ".join(words[start : start + max_tokens])
+        for start in range(0, max(len(words) - overlap, 1), step)
+    ]
 
-    # Decode HTML entities
-    text = unescape(text)
 
-    # Replace escape sequences and actual newlines/tabs
-    text = re.sub(r"\\[nt]", " ", text)
-    text = re.sub(r"[\n\t\r]", " ", text)
+def page_metadata(text, headers=None):
+    # Content hash plus the validators needed for conditional recrawls
+    metadata = {"content_hash": hashlib.sha256(text.encode("utf-8")).hexdigest()}
+    headers = {key.lower(): value for key, value in (headers or {}).items()}
+    if headers.get("etag"):
+        metadata["etag"] = headers["etag"]
+    if headers.get("last-modified"):
+        metadata["last_modified"] = headers["last-modified"]
+    return metadata
 
-    # Remove extra whitespace
-    text = re.sub(r"\s+", " ", text).strip()
 
-    return text
+def prepare_document(item):
+    url, text = clean_crawl_result(item)
+    if not text:
+        return url, [], None
+    res = item[1]
+    return url, chunk_text(text), page_metadata(text, res.response_headers)
 
 
-async def crawl_urls(urls):
-    if not urls:
-        return {}
+def store_chunks(chunked_docs, page_meta=None):
+    if not chunked_docs:
+        logging.info("No new URLs to add.")
+        return []
 
-    async with AsyncWebCrawler() as crawler:
-        results = await crawler.arun_many(urls=urls, config=crawler_config)
-    documents = {}
-    for res in results:
-        if res.success:
-            print(res.url, "crawled OK!")
-            documents[res.url] = clean_html(res.cleaned_html)
-        else:
-            print("Failed:", res.url, "-", res.error_message)
-    return documents
+    # Prepare batch data, one row per chunk
+    timestamp = datetime.datetime.now().isoformat()
+    ids = []
+    texts = []
+    metadatas = []
+    for url, chunks in chunked_docs.items():
+        for chunk_index, chunk in enumerate(chunks):
+            ids.append(str(uuid.uuid4()))
+            texts.append(chunk)
+            metadatas.append(
+                {
+                    "url": url,
+                    "chunk_index": chunk_index,
+                    "timestamp": timestamp,
+                    **(page_meta or {}).get(url, {}),
+                }
+            )
 
+    collection = get_collection()
+    for start in range(0, len(ids), CHROMA_ADD_BATCH):
+        end = start + CHROMA_ADD_BATCH
+        with metrics.time("stage_seconds", stage="chroma_add"):
+            collection.add(
+                ids=ids[start:end],
+                documents=texts[start:end],
+                metadatas=metadatas[start:end],
+            )
+    index_documents(ids, metadatas)
+    bm25_index.add(ids, texts)
+    with url_index_lock:
+        index_state["count"] += len(ids)
 
-def store_documents(docs):
+    logging.info(f"Stored {len(ids)} chunks from {len(chunked_docs)} new documents.")
+    return ids
 
-    # Filter out docs that already exist
-    # filtered_docs = filter_docs(docs)
 
-    if not docs:
-        logging.info("No new URLs to add.")
+@log_exception
+def ingest_urls(
+    urls,
+    timeout=None,
+    buffer_size=INGEST_BUFFER_SIZE,
+    batch_size=INGEST_BATCH_SIZE,
+    batch_chars=INGEST_BATCH_CHARS,
+    page_meta=None,
+):
+    # Stream crawl -> clean/chunk -> store, so pages become searchable batch by
+    # batch instead of waiting on the slowest URL. On timeout whatever was crawled
+    # is still stored before TimeoutError is raised.
+    if not urls:
         return []
 
-    # Prepare batch data
-    ids = [str(uuid.uuid4()) for _ in range(len(docs))]
+    ids = []
+    batch = {}
+    batch_meta = {}
+    pending_chars = 0
+    crawled = crawler_service.iter_crawl(urls, buffer_size, timeout)
+    prepared = run_stage(crawled, prepare_document, buffer_size)
+    try:
+        for url, chunks, meta in prepared:
+            if not chunks:
+                continue
+            batch[url] = chunks
+            batch_meta[url] = dict(meta, **(page_meta or {}))
+            pending_chars += sum(len(chunk) for chunk in chunks)
+            if len(batch) >= batch_size or pending_chars >= batch_chars:
+                ids.extend(store_chunks(batch, batch_meta))
+                batch = {}
+                batch_meta = {}
+                pending_chars = 0
+    finally:
+        # Stops the crawls right away if storing failed
+        prepared.close()
+        if batch:
+            ids.extend(store_chunks(batch, batch_meta))
+    return ids
+
 
-    # Since filtered_docs is a dict with URLs as keys and text as values
-    texts = list(docs.values())
-    urls = list(docs.keys())
-    metadatas = [
-        {"url": url, "timestamp": datetime.datetime.now().isoformat()} for url in urls
+def replace_document(url, chunks, meta):
+    # Store the new chunks before dropping the old ones so the page never disappears.
+    # Returns the text of the dropped chunks.
+    with url_index_lock:
+        old_ids = list(url_index.get(url, {}).get("ids", []))
+    store_chunks({url: chunks}, {url: meta})
+    old_documents = []
+    if old_ids:
+        old = get_collection().get(ids=old_ids, include=["documents"])
+        get_collection().delete(ids=old_ids)
+        bm25_index.remove(old["ids"])
+        old_documents = old["documents"]
+    with url_index_lock:
+        index_state["count"] -= len(old_documents)
+        stale = set(old_ids)
+        url_index[url]["ids"] = [i for i in url_index[url]["ids"] if i not in stale]
+    return old_documents
+
+
+def not_modified(url, entry):
+    # Conditional HEAD with the stored validators, True only on 304 Not Modified
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    if not headers:
+        return False
+    conditional = urllib.request.Request(url, headers=headers, method="HEAD")
+    try:
+        with urllib.request.urlopen(conditional, timeout=RECRAWL_TIMEOUT):
+            return False
+    except urllib.error.HTTPError as e:
+        return e.code == 304
+    except Exception:
+        return False
+
+
+@log_exception
+def refresh_stale_documents(budget=RECRAWL_BUDGET, max_age=RECRAWL_MAX_AGE):
+    # Oldest pages first: unchanged ones (304 or same content hash) only get a new
+    # timestamp, changed ones are re-cleaned, re-embedded and replaced
+    sync_indexes()
+    cutoff = (datetime.datetime.now() - datetime.timedelta(seconds=max_age)).isoformat()
+    with url_index_lock:
+        stale = sorted(
+            (entry["timestamp"] or "", url)
+            for url, entry in url_index.items()
+            if (entry["timestamp"] or "") < cutoff
+        )[:budget]
+        entries = {url: dict(url_index[url]) for _, url in stale}
+    if not entries:
+        return 0
+
+    urls = list(entries)
+    validated = recrawl_executor.map(not_modified, urls, entries.values())
+    unchanged = [url for url, same in zip(urls, validated) if same]
+    changed = [url for url in urls if url not in set(unchanged)]
+    replaced = 0
+    old_documents = []
+    if changed:
+        crawled = crawler_service.iter_crawl(changed, INGEST_BUFFER_SIZE)
+        with closing(
+            run_stage(crawled, prepare_document, INGEST_BUFFER_SIZE)
+        ) as prepared:
+            for url, chunks, meta in prepared:
+                if not chunks:
+                    # Keep the old copy, it is tried again once it goes stale
+                    unchanged.append(url)
+                elif meta["content_hash"] == entries[url].get("content_hash"):
+                    unchanged.append(url)
+                else:
+                    # The new copy stays in the page's knowledge pack
+                    if "emergency_type" in entries[url]:
+                        meta["emergency_type"] = entries[url]["emergency_type"]
+                    old_documents.extend(replace_document(url, chunks, meta))
+                    replaced += 1
+    touch_documents(unchanged)
+    if old_documents:
+        refresh_references(old_documents)
+
+    logging.info(
+        f"Recrawl: {len(entries)} stale pages, {replaced} replaced, "
+        f"{len(entries) - replaced} unchanged."
+    )
+    return replaced
+
+
+def recrawl_loop():
+    while True:
+        time.sleep(RECRAWL_INTERVAL)
+        try:
+            refresh_stale_documents()
+        except Exception:
+            # Already logged, the next run tries again
+            pass
+
+
+recrawl_started = threading.Event()
+
+
+def start_recrawl():
+    if RECRAWL_INTERVAL > 0 and not recrawl_started.is_set():
+        recrawl_started.set()
+        threading.Thread(target=recrawl_loop, name="recrawl", daemon=True).start()
+
+
+def dedupe_by_url(candidates, metadatas):
+    # Candidates are ranked best first, so the first chunk seen per URL is its best
+    seen = set()
+    unique = []
+    for candidate, metadata in zip(candidates, metadatas):
+        url = (metadata or {}).get("url")
+        if url is not None and url in seen:
+            continue
+        seen.add(url)
+        unique.append(candidate)
+    return unique
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def adaptive_cut(candidates):
+    # candidates are (document, fused score) best first. Keep at least the minimum,
+    # then only those close to the best score, capped at the maximum.
+    if not candidates:
+        return []
+    floor = candidates[0][1] * RERANK_CUT_RATIO
+    kept = [
+        document
+        for i, (document, score) in enumerate(candidates)
+        if i < RERANK_MIN_CANDIDATES or score >= floor
     ]
+    return kept[:RERANK_MAX_CANDIDATES]
 
-    # Add all documents in one batch
-    collection.add(ids=ids, documents=texts, metadatas=metadatas)
 
-    logging.info(f"Stored {len(docs)} new documents in batch.")
-    return ids
+def pack_key(query):
+    # Precomputed references are keyed by the user's question, not the generated
+    # search keyword, which differs from call to call. Case, punctuation and spacing
+    # are ignored.
+    return normalize_query(re.sub(r"[^\w\s]", " ", query))
 
 
-def retrieve_and_rerank(db_query, rerank_query):
-    docs = collection.query(query_texts=db_query, n_results=100)["documents"][0]
-    reranked_docs = co.rerank(
+def load_knowledge_packs():
+    # {emergency_type: {pack_key(query): [reference, ...]}}, written by ingest.py.
+    # A type is listed as soon as it has a pack, even without precomputed queries.
+    if not os.path.exists(KNOWLEDGE_PACK_PATH):
+        return {}
+    with open(KNOWLEDGE_PACK_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_knowledge_packs(packs):
+    # Write to a temporary file first so a crash never leaves half a file
+    tmp_path = f"{KNOWLEDGE_PACK_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(packs, f, ensure_ascii=False)
+    os.replace(tmp_path, KNOWLEDGE_PACK_PATH)
+
+
+@contextmanager
+def edit_knowledge_packs():
+    # Read-modify-write of the pack file under a file lock, so recrawl refreshes in
+    # the server and ingest.py runs never overwrite each other's changes. Yields the
+    # packs as currently on disk; this process's copy is updated once they are saved.
+    with open(f"{KNOWLEDGE_PACK_PATH}.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            packs = load_knowledge_packs()
+            yield packs
+            save_knowledge_packs(packs)
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    loaded = knowledge_packs.get()
+    for emergency_type in set(loaded) - set(packs):
+        loaded.pop(emergency_type, None)
+    loaded.update(packs)
+
+
+knowledge_packs = LazyService("packs", load_knowledge_packs)
+# (emergency type, normalized query) -> references from a recent full lookup
+reference_cache = TTLCache(REFERENCE_CACHE_SIZE, REFERENCE_CACHE_TTL)
+
+
+def has_pack(emergency_type):
+    return emergency_type in knowledge_packs.get()
+
+
+def pack_references(emergency_type, query):
+    # Precomputed pack answers for the user's question, looked up before any stage
+    # runs; a plain dict read, so frequent questions skip keyword generation,
+    # search, crawl and rerank entirely
+    pack = knowledge_packs.get().get(emergency_type, {})
+    references = pack.get(pack_key(query))
+    record_cache("packs", references is not None)
+    return references
+
+
+def cached_references(emergency_type, db_query):
+    # Recent live lookups for the search keyword
+    references = reference_cache.get((emergency_type, normalize_query(db_query)))
+    record_cache("references", references is not None)
+    return references
+
+
+def cache_references(emergency_type, db_query, references, skipped):
+    # Only complete lookups are reused, a local rerank fallback is not
+    if references and "rerank" not in skipped:
+        reference_cache.set((emergency_type, normalize_query(db_query)), references)
+
+
+def refresh_references(old_documents):
+    # After a recrawl replaced pages: precomputed references that quote one of the
+    # dropped chunks are computed again against the new copies, or removed when the
+    # rerank falls back; live lookups that quote one are dropped
+    old = set(old_documents)
+
+    def stale(references):
+        return not old.isdisjoint(references)
+
+    reference_cache.discard_values(stale)
+    rebuilt = {}
+    for emergency_type, pack in list(knowledge_packs.get().items()):
+        for key, references in list(pack.items()):
+            if not stale(references):
+                continue
+            skipped = []
+            references = retrieve_and_rerank(
+                key, key, skipped=skipped, emergency_type=emergency_type
+            )
+            rebuilt[emergency_type, key] = None if skipped else references
+    if not rebuilt:
+        return
+    # Entries ingest.py rewrote in the meantime are kept
+    with edit_knowledge_packs() as packs:
+        for (emergency_type, key), references in rebuilt.items():
+            pack = packs.get(emergency_type, {})
+            if key not in pack or not stale(pack[key]):
+                continue
+            if references is None:
+                del pack[key]
+            else:
+                pack[key] = references
+    logging.info(f"Recrawl: {len(rebuilt)} precomputed pack queries refreshed.")
+
+
+def query_candidates(db_query, emergency_type=None):
+    # Types with a knowledge pack search their own partition, and the whole corpus
+    # only when it has nothing for the query
+    collection = get_collection()
+    where = {"emergency_type": emergency_type} if has_pack(emergency_type) else None
+    with metrics.time("stage_seconds", stage="chroma_query"):
+        dense = collection.query(
+            query_texts=db_query,
+            n_results=HYBRID_DENSE_K,
+            where=where,
+            include=["metadatas"],
+        )["ids"][0]
+    sparse = [doc_id for doc_id, _ in bm25_index.search(db_query, HYBRID_SPARSE_K)]
+    fused = reciprocal_rank_fusion([dense, sparse])[: RERANK_MAX_CANDIDATES * 4]
+    if not fused:
+        return []
+
+    found = collection.get(
+        ids=[doc_id for doc_id, _ in fused], include=["documents", "metadatas"]
+    )
+    by_id = {
+        doc_id: (document, metadata)
+        for doc_id, document, metadata in zip(
+            found["ids"], found["documents"], found["metadatas"]
+        )
+    }
+    ranked = [(by_id[doc_id], score) for doc_id, score in fused if doc_id in by_id]
+    if where is not None:
+        # BM25 covers the whole corpus, drop hits from outside the pack
+        ranked = [
+            ((document, metadata), score)
+            for (document, metadata), score in ranked
+            if metadata.get("emergency_type") == emergency_type
+        ]
+        if not ranked:
+            return query_candidates(db_query)
+    candidates = dedupe_by_url(
+        [(document, score) for (document, _), score in ranked],
+        [metadata for (_, metadata), _ in ranked],
+    )
+    return adaptive_cut(candidates)
+
+
+def load_cross_encoder():
+    if CrossEncoder is None:
+        return None
+    return CrossEncoder(LOCAL_RERANK_MODEL)
+
+
+cross_encoder = LazyService("cross_encoder", load_cross_encoder)
+
+
+def local_rerank(rerank_query, docs, top_n=RERANK_TOP_N):
+    # Fallback when Cohere is slow or down. The model is never loaded on the request
+    # path: until warm-up has loaded it, the fused order is kept.
+    if not cross_encoder.ready:
+        start_warmup(("cross_encoder",))
+        return docs[:top_n]
+    model = cross_encoder.get()
+    if model is None:
+        return docs[:top_n]
+    scores = model.predict([(rerank_query, doc) for doc in docs])
+    order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)
+    return [docs[i] for i in order[:top_n]]
+
+
+def rerank_flight_key(rerank_query, docs):
+    digest = hashlib.sha256("\0".join(docs).encode("utf-8")).hexdigest()
+    return rerank_query, digest
+
+
+def retrieve_and_rerank(
+    db_query, rerank_query, timeout=RERANK_TIMEOUT, skipped=None, emergency_type=None
+):
+    docs = query_candidates(db_query, emergency_type)
+    if not docs:
+        return []
+    future = rerank_executor.submit(
+        outbound,
+        "cohere",
+        get_cohere().rerank,
+        flight_key=rerank_flight_key(rerank_query, docs),
         query=rerank_query,
         documents=docs,
-        top_n=10,  # Make sure we don't request more than we have
+        top_n=min(
+            RERANK_TOP_N, len(docs)
+        ),  # Make sure we don't request more than we have
         model="rerank-v3.5",
+        request_options=COHERE_REQUEST_OPTIONS,
     )
-    return reranked_docs
+    start = time.perf_counter()
+    try:
+        reranked_docs = future.result(timeout=timeout)
+    except Exception as e:
+        logging.warning(f"Cohere rerank failed ({e!r}), reranking locally")
+        future.cancel()
+        metrics.inc("rerank_fallbacks")
+        if skipped is not None:
+            skipped.append("rerank")
+        return local_rerank(rerank_query, docs)
+    metrics.observe("stage_seconds", time.perf_counter() - start, stage="rerank")
+    return [docs[result.index] for result in reranked_docs.results]
 
 
 # Old API
@@ -244,106 +1966,492 @@ def retrieve_and_rerank(db_query, rerank_query):
 #             status=200, mimetype='application/json')
 
 
-def transcribe(media_bytes, media_type):
-    instruction = """Transcribe the content of this media accurately.  
+TRANSCRIBE_CONFIG = GenerateContentConfig(
+    response_modalities=["TEXT"],
+    system_instruction="""Transcribe the content of this media accurately.  
         - If this is an audio or video, generate a detailed and structured transcript.  
         - If this is an image, provide a rich and informative description of its contents.
         Ensure the transcription is **clear, precise, and useful for future reference** in assisting the user during an emergency.  
         Avoid markdown and emojis.
-        """
+        """,
+)
+KEYWORD_CONFIG = GenerateContentConfig(
+    response_modalities=["TEXT"],
+    response_mime_type="application/json",
+    response_schema={
+        "type": "OBJECT",
+        "properties": {
+            "search_keyword": {
+                "type": "STRING",
+                "description": "Search keyword string or null value",
+            },
+            "reranker_query": {
+                "type": "STRING",
+                "description": "Query for reranker string or null value",
+            },
+        },
+    },
+)
+SUMMARY_CONFIG = GenerateContentConfig(
+    response_modalities=["TEXT"],
+    max_output_tokens=HISTORY_SUMMARY_TOKENS,
+    system_instruction="""Summarize this emergency conversation between a user and an assistant.
+        Keep every fact that may still matter: the user's location, the people involved, injuries, threats, what has already been done and what the assistant advised.
+        If an earlier summary is given, fold the new messages into it. Be concise and avoid markdown and emojis.
+        """,
+)
 
-    GEMINI_CONFIG.response_mime_type = None
-    GEMINI_CONFIG.response_schema = None
-    GEMINI_CONFIG.system_instruction = instruction
-    response = client.models.generate_content(
-        model=model_id,
-        contents=[
-            Content(
-                role="user",
-                parts=Part.from_bytes(data=media_bytes, mime_type=media_type),
-            )
-        ],
-        config=GEMINI_CONFIG,
-    )
 
+def with_instruction(config, instruction):
+    # Request-scoped copy, the shared stage config is left untouched
+    return config.model_copy(update={"system_instruction": instruction})
+
+
+def with_timeout(config, seconds):
+    # Request-scoped copy whose HTTP calls give up after seconds
+    timeout = HttpOptions(timeout=max(int(seconds * 1000), 1))
+    return config.model_copy(update={"http_options": timeout})
+
+
+def spool_media(stream):
+    # Copy an upload in chunks into a temp file that only spills to disk once it
+    # outgrows the inline limit, rejecting it as soon as it passes MEDIA_MAX_BYTES.
+    # The content hash is computed on the way through.
+    spooled = tempfile.SpooledTemporaryFile(max_size=MEDIA_INLINE_MAX_BYTES)
+    digest = hashlib.sha256()
+    size = 0
+    while chunk := stream.read(MEDIA_CHUNK_SIZE):
+        size += len(chunk)
+        if size > MEDIA_MAX_BYTES:
+            spooled.close()
+            raise RequestEntityTooLarge(f"Media is larger than {MEDIA_MAX_BYTES} bytes")
+        digest.update(chunk)
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled, size, digest.hexdigest()
+
+
+def media_part(spooled, size, media_type, deadline=None):
+    # Built once per request and shared by the transcription and answer calls
+    if size <= MEDIA_INLINE_MAX_BYTES:
+        return Part.from_bytes(data=spooled.read(), mime_type=media_type)
+
+    # Large media is uploaded once and referenced by URI, uploads expire on their own.
+    # Uploading and waiting for processing share the upload budget.
+    budget = Deadline((deadline or Deadline(REQUEST_DEADLINE)).budget("upload"))
+
+    def http_options():
+        return {"timeout": max(int(budget.remaining() * 1000), 1)}
+
+    def upload():
+        # A retry sends the file again from the start
+        spooled.seek(0)
+        return get_client().files.upload(
+            file=spooled,
+            config={"mime_type": media_type, "http_options": http_options()},
+        )
+
+    uploaded = outbound("gemini", upload, deadline=budget)
+    while uploaded.state and uploaded.state.name == "PROCESSING":
+        if budget.remaining() <= 1:
+            raise GatewayTimeout("Media was still processing when its budget ran out")
+        time.sleep(1)
+        uploaded = outbound(
+            "gemini",
+            get_client().files.get,
+            deadline=budget,
+            name=uploaded.name,
+            config={"http_options": http_options()},
+        )
+    if uploaded.state and uploaded.state.name == "FAILED":
+        raise UnprocessableEntity(f"Media processing failed: {uploaded.error}")
+    return Part.from_uri(file_uri=uploaded.uri, mime_type=media_type)
+
+
+def media_cache_key(digest, media_type):
+    return f"{digest}:{media_type}"
+
+
+def transcribe(media, cache_key=None):
+    # Retries and follow-up turns re-send the same recording, reuse its transcript
+    if cache_key is not None:
+        transcription = transcript_cache.get(cache_key)
+        record_cache("transcript", transcription is not None)
+        if transcription is not None:
+            logging.info(f"Transcript cache hit: {cache_key}")
+            return transcription
+
+    with metrics.time("stage_seconds", stage="transcribe"):
+        response = outbound(
+            "gemini",
+            get_client().models.generate_content,
+            flight_key=cache_key,
+            model=model_id,
+            contents=[Content(role="user", parts=[media])],
+            config=TRANSCRIBE_CONFIG,
+        )
+    record_usage("transcribe", response)
+
+    if cache_key is not None and response.text:
+        transcript_cache.set(cache_key, response.text)
     return response.text
 
 
-@app.route("/", methods=["POST"])
-def ai_pipeline():
-    if request.mimetype == "application/json":
-        data = request.get_json()
-        print("Data:", data)
-        media = None
-    else:
-        data = request.form
-        media = request.files.get("audio", None)
-        if media is None:
-            media = request.files.get("video", None)
-        if media is None:
-            media = request.files.get("image", None)
-    media_type = request.mimetype
-    message_history = json.loads(data["chat_history"])
-    query = data["query"]
-    emergency_type = data["emergency_type"]
+def history_fingerprint(message_history, query):
+    # The client appends the current query to chat_history, leave it out so the
+    # fingerprint only reflects the conversation that led up to it
+    recent = message_history
+    if recent and recent[-1].get("role") == "user" and recent[-1].get("text") == query:
+        recent = recent[:-1]
+    return messages_digest(recent[-RESPONSE_CACHE_HISTORY:])
+
+
+def messages_digest(messages):
+    pairs = [[m.get("role"), m.get("text")] for m in messages]
+    return hashlib.sha256(json.dumps(pairs).encode("utf-8")).hexdigest()
 
+
+def history_contents(message_history):
     contents = []
     for message in message_history:
         contents.append(
             Content(role=message["role"], parts=[{"text": message["text"]}])
         )
-    print(contents)
-    transcription = None
-    if media is not None:
-        # media.save(media.filename)
-        # with open(media.filename, 'rb') as f:
-        media_bytes = media.read()
-        contents.append(
-            Content(
-                role="user",
-                parts=Part.from_bytes(data=media_bytes, mime_type=media_type),
-            )
+    return contents
+
+
+def estimate_tokens(text):
+    # About four characters per token, close enough for budgeting without a
+    # count_tokens round trip
+    return len(text or "") // 4 + 1
+
+
+def history_cutoff(message_history):
+    # Number of leading messages to summarize, 0 when the history fits the budget
+    tokens = [estimate_tokens(message.get("text")) for message in message_history]
+    if sum(tokens) <= HISTORY_TOKEN_BUDGET:
+        return 0
+    budget = HISTORY_TOKEN_BUDGET - HISTORY_SUMMARY_TOKENS
+    cutoff = len(tokens)
+    while cutoff > 0:
+        cost = tokens[cutoff - 1]
+        if len(tokens) - cutoff >= HISTORY_MIN_RECENT and cost > budget:
+            break
+        budget -= cost
+        cutoff -= 1
+    # Summaries advance in whole steps so one summary serves several turns. Rounding
+    # up keeps the rest within budget, short of the messages that stay verbatim.
+    step_cutoff = -(-cutoff // HISTORY_SUMMARY_STEP) * HISTORY_SUMMARY_STEP
+    return min(step_cutoff, max(len(tokens) - HISTORY_MIN_RECENT, 0))
+
+
+def session_key(message_history, session_id=None):
+    # Clients that send no session id are keyed by their opening message
+    if session_id:
+        return session_id
+    return messages_digest(message_history[:1])
+
+
+def summarize_history(summary, messages, timeout):
+    transcript = "\n".join(f"{m.get('role')}: {m.get('text')}" for m in messages)
+    if summary:
+        transcript = f"Earlier summary: {summary}\n\nNew messages:\n{transcript}"
+    with metrics.time("stage_seconds", stage="summary"):
+        response = outbound(
+            "gemini",
+            get_client().models.generate_content,
+            deadline=Deadline(timeout),
+            model=model_id,
+            contents=transcript,
+            config=with_timeout(SUMMARY_CONFIG, timeout),
         )
-        transcription = transcribe(media_bytes, media_type)
+    record_usage("summary", response)
+    return response.text
+
+
+def extend_summary(key, summary, message_history, summarized, cutoff, timeout):
+    summary = summarize_history(summary, message_history[summarized:cutoff], timeout)
+    summary_cache.set(key, (cutoff, messages_digest(message_history[:cutoff]), summary))
+    return summary
+
+
+def compact_history(message_history, session_id=None, deadline=None):
+    # Recent messages stay verbatim, older ones are replaced by the session's rolling
+    # summary, which is extended with the newly aged-out messages when needed. When
+    # the summary fails or misses its share of the deadline the history goes in full.
+    deadline = deadline or Deadline(REQUEST_DEADLINE)
+    cutoff = history_cutoff(message_history)
+    if cutoff == 0:
+        return history_contents(message_history)
+
+    key = session_key(message_history, session_id)
+    summarized, summary = 0, None
+    cached = summary_cache.get(key)
+    if cached is not None:
+        count, digest, cached_summary = cached
+        if count <= cutoff and digest == messages_digest(message_history[:count]):
+            summarized, summary = count, cached_summary
+    record_cache("summary", summarized == cutoff)
+    if summarized < cutoff:
+        timeout = deadline.budget("summary")
+        try:
+            summary = budget_executor.submit(
+                extend_summary,
+                key,
+                summary,
+                message_history,
+                summarized,
+                cutoff,
+                timeout,
+            ).result(timeout=timeout)
+        except Exception as e:
+            logging.warning(f"History summary failed ({e!r}), sending it in full")
+            return history_contents(message_history)
+
+    summary_content = Content(
+        role="user",
+        parts=[{"text": f"Summary of the earlier conversation: {summary}"}],
+    )
+    return [summary_content] + history_contents(message_history[cutoff:])
+
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return Response(
+        json.dumps({"response_cache": response_cache.stats()}),
+        status=200,
+        mimetype="application/json",
+    )
+
+
+METRICS_MIMETYPE = "text/plain; version=0.0.4"
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), status=200, mimetype=METRICS_MIMETYPE)
+
+
+def warm_packs():
+    # Types with a pack retrieve and rerank from the corpus on a pack miss, even
+    # without web retrieval, so their clients load along with the packs
+    if knowledge_packs.get():
+        start_warmup(("chroma", "cohere"))
+
+
+WARMERS = {
+    "gemini": gemini.get,
+    "embeddings": embedding_model.get,
+    "chroma": chroma.get,
+    "cohere": cohere_service.get,
+    "cross_encoder": cross_encoder.get,
+    "crawler": crawler_service.start,
+    "packs": warm_packs,
+}
+warmup_lock = threading.Lock()
+warmup_started = set()
+# name -> (consecutive failures, monotonic time before which it is not retried)
+warmup_failures = {}
+
+
+def warm(names):
+    for name in names:
+        try:
+            WARMERS[name]()
+        except Exception as e:
+            with warmup_lock:
+                failures = warmup_failures.get(name, (0, 0))[0] + 1
+                delay = min(WARMUP_RETRY_BASE * 2 ** (failures - 1), WARMUP_RETRY_MAX)
+                warmup_failures[name] = (failures, time.monotonic() + delay)
+                warmup_started.discard(name)
+            metrics.inc("warmup_failures", service=name)
+            logging.error(f"Warm-up of {name} failed: {e!r}, retry in {delay:.0f}s")
+        else:
+            with warmup_lock:
+                warmup_failures.pop(name, None)
+
+
+def start_warmup(names):
+    # Loads services in the background, each at most once; one that failed is tried
+    # again once its backoff has passed, not on every request that wants it
+    now = time.monotonic()
+    with warmup_lock:
+        names = [
+            name
+            for name in names
+            if name not in warmup_started
+            and warmup_failures.get(name, (0, 0))[1] <= now
+        ]
+        warmup_started.update(names)
+    if names:
+        threading.Thread(target=warm, args=(names,), name="warmup", daemon=True).start()
+
+
+def readiness():
+    return {
+        "gemini": gemini.ready,
+        "embeddings": embedding_model.ready,
+        "chroma": chroma.ready,
+        "cohere": cohere_service.ready,
+        "cross_encoder": cross_encoder.ready,
+        "crawler": crawler_service.ready,
+        "packs": knowledge_packs.ready,
+    }
+
+
+@app.before_request
+def start_services():
+    # Runs under any WSGI server, not just the dev server's __main__. Both calls are
+    # no-ops once started, and the browsers launch in the background.
+    start_warmup(PREWARM_SERVICES if PREWARM else STARTUP_SERVICES)
+    start_recrawl()
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    return Response("ok", status=200, mimetype="text/plain")
+
 
-    pre_instruction = f"""
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    # Ready once text-only requests can be served, retrieval may still be loading
+    services = readiness()
+    ready = all(services[name] for name in READY_SERVICES)
+    return Response(
+        json.dumps({"ready": ready, "services": services}),
+        status=200 if ready else 503,
+        mimetype="application/json",
+    )
+
+
+@app.route("/warmup", methods=["POST"])
+def warmup():
+    start_warmup(PREWARM_SERVICES)
+    return Response(
+        json.dumps({"services": readiness()}),
+        status=202,
+        mimetype="application/json",
+    )
+
+
+def flag(data, name):
+    return str(data.get(name, "")).lower() in ("1", "true")
+
+
+def wants_stream(data, accept):
+    # SSE when the client asks for an event stream, JSON lines when it sets "stream"
+    if "text/event-stream" in accept:
+        return "sse"
+    if flag(data, "stream"):
+        return "ndjson"
+    return None
+
+
+def observe_request(content_length, media_size=None):
+    metrics.inc("requests", kind="text" if media_size is None else "media")
+    metrics.observe("request_bytes", content_length or 0, SIZE_BUCKETS)
+    if media_size is not None:
+        metrics.observe("media_bytes", media_size, SIZE_BUCKETS)
+
+
+def format_event(event, stream_format):
+    line = json.dumps(event, ensure_ascii=False)
+    return f"data: {line}\n\n" if stream_format == "sse" else line + "\n"
+
+
+def timed(fn, kwargs):
+    start = time.perf_counter()
+    result = fn(**kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_stages(stages, timings, deadline, skipped):
+    # stages maps name -> (dependency names, fn). Each stage starts on the pipeline
+    # executor once its dependencies are done and gets their results as keyword
+    # arguments, plus a skipped list of its own for the steps it left out. A stage
+    # that fails or outlives its budget yields None and is added to skipped. An
+    # overrunning stage is abandoned, not stopped: a running thread cannot be
+    # interrupted, so it keeps its worker until its own call returns and its result
+    # and skipped steps are dropped. Yields (name, result) in completion order and
+    # fills timings.
+    results = {}
+    pending = dict(stages)
+    running = {}
+    expires = {}
+    started = {}
+    stage_skipped = {}
+    try:
+        while pending or running:
+            for name, (deps, fn) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    del pending[name]
+                    kwargs = {dep: results[dep] for dep in deps}
+                    kwargs["skipped"] = []
+                    future = pipeline_executor.submit(timed, fn, kwargs)
+                    stage_skipped[future] = kwargs["skipped"]
+                    running[future] = name
+                    started[future] = time.monotonic()
+                    expires[future] = started[future] + deadline.budget(name)
+            timeout = max(
+                min(expires[future] for future in running) - time.monotonic(), 0
+            )
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for future in list(running):
+                if future not in done and expires[future] > now:
+                    continue
+                name = running.pop(future)
+                try:
+                    if future not in done:
+                        raise TimeoutError("stage ran over its budget")
+                    results[name], timings[name] = future.result()
+                    skipped.extend(stage_skipped[future])
+                except Exception as e:
+                    logging.warning(f"Skipping stage {name}: {e!r}")
+                    results[name] = None
+                    timings[name] = now - started[future]
+                    skipped.append(name)
+                yield name, results[name]
+    finally:
+        # Only stops stages that have not started yet
+        for future in running:
+            future.cancel()
+
+
+def done_event(text, transcription, timings, skipped):
+    logging.info(f"Stage timings: {server_timing(timings)}")
+    for name, seconds in timings.items():
+        metrics.observe("pipeline_stage_seconds", seconds, stage=name)
+    for name in skipped:
+        metrics.inc("skipped_stages", stage=name)
+    if skipped:
+        logging.info(f"Skipped stages: {skipped}")
+    return {
+        "type": "done",
+        "response": text,
+        "transcription": transcription,
+        "skipped_stages": skipped,
+        "timings": {name: round(seconds, 4) for name, seconds in timings.items()},
+    }
+
+
+def server_timing(timings):
+    return ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()
+    )
+
+
+def keyword_instruction(query, emergency_type):
+    return f"""
         A user is in an emergency ({emergency_type}). Based on the chat history, the user's current media (audio/image/video/None), and their query: "{query}",  
         1. Generate a concise keyword or phrase most relevant to the situation for web search. If unnecessary, return "null".  
         2. Combine the user's query and the generated keyword/phrase to form an optimized query for reranking search results. If unnecessary, return "null".
         """
 
-    GEMINI_CONFIG.response_mime_type = "application/json"
-    GEMINI_CONFIG.response_schema = GEMINI_CONFIG.response_schema = {
-        "type": "OBJECT",
-        "properties": {
-            "search_keyword": {
-                "type": "STRING",
-                "description": "Search keyword string or null value",
-            },
-            "reranker_query": {
-                "type": "STRING",
-                "description": "Query for reranker string or null value",
-            },
-        },
-    }
-    GEMINI_CONFIG.system_instruction = pre_instruction
-
-    response = client.models.generate_content(
-        model=model_id, contents=contents, config=GEMINI_CONFIG
-    )
 
-    # # Retrieve and Rerank
-    # response_data = json.loads(response.text)
-    # db_query = response_data["search_keyword"]
-    # rerank_query = response_data["reranker_query"]
-    # urls = google_search(db_query)
-    # filtered_urls = filter_urls(urls)
-    # docs = asyncio.run(crawl_urls(filtered_urls))
-    # store_documents(docs)
-    # docs = retrieve_and_rerank(db_query, rerank_query)
-    docs = None
-
-    post_instruction = f"""
+def answer_instruction(query, emergency_type, references):
+    docs = "\n\n".join(references) if references else None
+    return f"""
         You are an emergency AI assistant. Given the references below and the user's current media (audio/image/video/None), their query: "{query}" and emergency type: "{emergency_type}", 
         provide a natural and conversational response. Avoid markdown and emojis.
         References:  
@@ -351,24 +2459,257 @@ def ai_pipeline():
         Consider previous conversation context when relevant. Use both the provided references and your own knowledge to generate a helpful response.
         """
 
-    GEMINI_CONFIG.response_mime_type = None
-    GEMINI_CONFIG.response_schema = None
-    GEMINI_CONFIG.system_instruction = post_instruction
 
-    response = client.models.generate_content(
-        model=model_id, contents=contents, config=GEMINI_CONFIG
+def generate_keywords(contents, query, emergency_type):
+    with metrics.time("stage_seconds", stage="keywords"):
+        response = outbound(
+            "gemini",
+            get_client().models.generate_content,
+            model=model_id,
+            contents=contents,
+            config=with_instruction(
+                KEYWORD_CONFIG, keyword_instruction(query, emergency_type)
+            ),
+        )
+    record_usage("keywords", response)
+    return json.loads(response.text)
+
+
+def reference_queries(keywords):
+    # (db_query, rerank_query), or None when the keywords call for no references
+    if not keywords:
+        return None
+    db_query = keywords.get("search_keyword")
+    rerank_query = keywords.get("reranker_query")
+    if not db_query or db_query == "null":
+        return None
+    if not rerank_query or rerank_query == "null":
+        rerank_query = db_query
+    return db_query, rerank_query
+
+
+def find_references(keywords, emergency_type, deadline, skipped):
+    # Retrieve and Rerank, each step within its share of the deadline. Without
+    # search results there are no references; a late crawl still reranks whatever
+    # the corpus already has. Without web retrieval only knowledge packs are used.
+    queries = reference_queries(keywords)
+    if queries is None:
+        return None
+    db_query, rerank_query = queries
+    references = cached_references(emergency_type, db_query)
+    if references is not None:
+        return references
+    if WEB_RETRIEVAL:
+        try:
+            urls = budget_executor.submit(google_search, db_query).result(
+                timeout=deadline.budget("search")
+            )
+        except Exception as e:
+            logging.warning(f"Skipping stage search: {e!r}")
+            skipped.append("search")
+            return None
+        filtered_urls = filter_urls(urls)
+        try:
+            ingest_urls(filtered_urls, timeout=deadline.budget("crawl"))
+        except TimeoutError:
+            skipped.append("crawl")
+    elif not has_pack(emergency_type):
+        return None
+    references = retrieve_and_rerank(
+        db_query,
+        rerank_query,
+        timeout=deadline.budget("rerank"),
+        skipped=skipped,
+        emergency_type=emergency_type,
+    )
+    cache_references(emergency_type, db_query, references, skipped)
+    return references
+
+
+def pipeline_events(
+    contents,
+    media,
+    media_key,
+    query,
+    emergency_type,
+    cache_bucket,
+    stream,
+    timings,
+    skipped,
+    deadline,
+):
+    # Transcription and keyword generation only depend on the request, so they run
+    # concurrently and references follow the keywords; a knowledge pack answer for
+    # the question replaces both. Yields the transcription as soon as it is known,
+    # then the answer either as deltas (stream) or in one piece, and finally a
+    # "done" event with the full text.
+    references = pack_references(emergency_type, query)
+    stages = {}
+    if references is None:
+        stages["keywords"] = (
+            (),
+            lambda skipped: generate_keywords(contents, query, emergency_type),
+        )
+        stages["references"] = (
+            ("keywords",),
+            lambda keywords, skipped: find_references(
+                keywords, emergency_type, deadline, skipped
+            ),
+        )
+    if media is not None:
+        stages["transcription"] = (
+            (),
+            lambda skipped: transcribe(media, media_key),
+        )
+
+    results = {"transcription": None, "references": references}
+    for name, result in run_stages(stages, timings, deadline, skipped):
+        results[name] = result
+        if name == "transcription":
+            yield {"type": "transcription", "transcription": result}
+    transcription = results["transcription"]
+    # The answer gets what is left of the deadline, stages leave it ANSWER_RESERVE
+    config = with_timeout(
+        with_instruction(
+            ANSWER_CONFIG,
+            answer_instruction(query, emergency_type, results["references"]),
+        ),
+        deadline.remaining(),
+    )
+
+    start = time.perf_counter()
+    if stream:
+        parts = []
+        response = None
+        # Deltas may already have been sent, so a stream is rate limited but not
+        # retried
+        rate_limiter("gemini").acquire()
+        for response in get_client().models.generate_content_stream(
+            model=model_id, contents=contents, config=config
+        ):
+            if response.text:
+                parts.append(response.text)
+                yield {"type": "delta", "text": response.text}
+        text = "".join(parts)
+    else:
+        response = outbound(
+            "gemini",
+            get_client().models.generate_content,
+            deadline=deadline,
+            model=model_id,
+            contents=contents,
+            config=config,
+        )
+        text = response.text
+    timings["answer"] = time.perf_counter() - start
+    metrics.observe("stage_seconds", timings["answer"], stage="answer")
+    # Streamed responses report usage on the last chunk
+    record_usage("answer", response)
+    # An answer built without some of its stages is not reused
+    if cache_bucket is not None and text and not skipped:
+        response_cache.set(cache_bucket, query, text)
+
+    yield done_event(text, transcription, timings, skipped)
+
+
+@app.route("/", methods=["POST"])
+def ai_pipeline():
+    if request.mimetype == "application/json":
+        data = request.get_json()
+        print("Data:", data)
+        media = None
+    else:
+        data = request.form
+        media = request.files.get("audio", None)
+        if media is None:
+            media = request.files.get("video", None)
+        if media is None:
+            media = request.files.get("image", None)
+    # Everything after parsing, history compaction included, shares one deadline
+    deadline = Deadline(REQUEST_DEADLINE)
+    message_history = json.loads(data["chat_history"])
+    query = data["query"]
+    emergency_type = data["emergency_type"]
+    stream_format = wants_stream(data, request.headers.get("Accept", ""))
+    # "profile" adds the per-stage timing breakdown to the JSON response
+    profile = flag(data, "profile")
+
+    # Text-only requests can be answered from earlier near-identical questions
+    cache_bucket = None
+    if media is None:
+        observe_request(request.content_length)
+        cache_bucket = (emergency_type, history_fingerprint(message_history, query))
+        cached_response = response_cache.get(cache_bucket, query)
+        if cached_response is not None:
+            logging.info(f"Response cache hit: {query}")
+            if stream_format:
+                event = {
+                    "type": "done",
+                    "response": cached_response,
+                    "transcription": None,
+                }
+                return Response(
+                    format_event(event, stream_format),
+                    status=200,
+                    mimetype=STREAM_MIMETYPES[stream_format],
+                )
+            return Response(
+                json.dumps(
+                    {"response": cached_response, "transcription": None},
+                    ensure_ascii=False,
+                ),
+                status=200,
+                mimetype="application/json",
+            )
+
+    contents = compact_history(message_history, data.get("session_id"), deadline)
+    print(contents)
+    part = None
+    media_key = None
+    if media is not None:
+        media_type = media.mimetype or request.mimetype
+        spooled, size, digest = spool_media(media.stream)
+        observe_request(request.content_length, size)
+        with spooled:
+            part = media_part(spooled, size, media_type, deadline)
+        media_key = media_cache_key(digest, media_type)
+        contents.append(Content(role="user", parts=[part]))
+
+    timings = {}
+    skipped = []
+    events = pipeline_events(
+        contents,
+        part,
+        media_key,
+        query,
+        emergency_type,
+        cache_bucket,
+        stream_format is not None,
+        timings,
+        skipped,
+        deadline,
     )
+    if stream_format:
+        return Response(
+            (format_event(event, stream_format) for event in events),
+            status=200,
+            mimetype=STREAM_MIMETYPES[stream_format],
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
+    result = list(events)[-1]
+    body = {
+        "response": result["response"],
+        "transcription": result["transcription"],
+        "skipped_stages": result["skipped_stages"],
+    }
+    if profile:
+        body["timings"] = result["timings"]
     return Response(
-        json.dumps(
-            {
-                "response": response.text,
-                "transcription": transcription,
-            },
-            ensure_ascii=False,
-        ),
+        json.dumps(body, ensure_ascii=False),
         status=200,
         mimetype="application/json",
+        headers={"Server-Timing": server_timing(timings)},
     )
 
 
@@ -583,4 +2924,8 @@ def ai_pipeline():
 #             status=200, mimetype='application/json')
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", debug=True)
+    # With the reloader on, only the serving child process launches the browsers
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_warmup(PREWARM_SERVICES if PREWARM else STARTUP_SERVICES)
+        start_recrawl()
+    app.run(host="0.0.0.0", debug=True, threaded=True)
@@ -0,0 +1,47 @@
+import os
+import re
+import sys
+import tempfile
+from html import unescape
+
+import pytest
+
+# Tests import the server modules the same way main.py is run, from lib/
+LIB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LIB_DIR)
+
+# main.py opens its stores from the environment at import, keep them out of the tree
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="lib-tests-")
+for name, value in {
+    "CHROMA_PERSIST_DIRECTORY": os.path.join(TEST_DATA_DIR, "chroma"),
+    "COLLECTION_NAME": "tests",
+    "EMBEDDING_CACHE_DIR": os.path.join(TEST_DATA_DIR, "embeddings"),
+    "TRANSCRIPT_CACHE_PATH": os.path.join(TEST_DATA_DIR, "transcripts.sqlite3"),
+    "KNOWLEDGE_PACK_PATH": os.path.join(TEST_DATA_DIR, "knowledge_packs.json"),
+}.items():
+    os.environ.setdefault(name, value)
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pages")
+
+
+def reference_clean_html(html_content):
+    # The original four-pass clean_html, kept as the oracle for the fast one
+    text = re.sub(r"<[^>]+>", "", html_content)
+    text = unescape(text)
+    text = re.sub(r"\\[nt]", " ", text)
+    text = re.sub(r"[\n\t\r]", " ", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return text
+
+
+def load_pages():
+    pages = {}
+    for name in sorted(os.listdir(PAGES_DIR)):
+        with open(os.path.join(PAGES_DIR, name), encoding="utf-8") as f:
+            pages[name] = f.read()
+    return pages
+
+
+@pytest.fixture(scope="session")
+def pages():
+    return load_pages()
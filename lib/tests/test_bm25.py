@@ -0,0 +1,69 @@
+import threading
+
+from main import BM25Index
+
+DOCUMENTS = {
+    "fire": "leave the building if there is smoke or fire",
+    "flood": "move to higher ground if there is a flood",
+    "quake": "drop, cover and hold on during an earthquake",
+    "smoke": "smoke alarms save lives, test the smoke alarm monthly",
+}
+
+
+def open_index(tmp_path, max_doc_fraction=0.5):
+    index = BM25Index(str(tmp_path / "bm25.sqlite3"), max_doc_fraction)
+    index.add(list(DOCUMENTS), list(DOCUMENTS.values()))
+    return index
+
+
+def ids(hits):
+    return [doc_id for doc_id, _ in hits]
+
+
+def test_ranks_more_matching_terms_first(tmp_path):
+    hits = open_index(tmp_path).search("smoke alarm", 10)
+    assert ids(hits) == ["smoke", "fire"]
+    assert hits[0][1] > hits[1][1] > 0
+
+
+def test_limits_results(tmp_path):
+    index = open_index(tmp_path)
+    assert len(index.search("smoke flood earthquake", 10)) == 4
+    assert ids(index.search("smoke flood earthquake", 2)) == ["quake", "flood"]
+
+
+def test_skips_terms_in_most_chunks(tmp_path):
+    # "the", "if" and "there" are each in half the chunks
+    index = open_index(tmp_path, max_doc_fraction=0.4)
+    assert index.search("the if there", 10) == []
+    assert ids(index.search("the flood", 10)) == ["flood"]
+
+
+def test_query_syntax_is_literal(tmp_path):
+    index = open_index(tmp_path)
+    for query in ('"smoke', "smoke AND NOT", "smoke*", "NEAR(smoke fire)", "-", ""):
+        assert set(ids(index.search(query, 10))) <= set(DOCUMENTS)
+
+
+def test_remove_and_duplicate_add(tmp_path):
+    index = open_index(tmp_path)
+    index.add(["fire"], ["something else"])
+    index.remove(["smoke", "missing"])
+    assert len(index) == 3
+    assert ids(index.search("smoke", 10)) == ["fire"]
+
+
+def test_shared_between_instances_and_threads(tmp_path):
+    open_index(tmp_path)
+    other = BM25Index(str(tmp_path / "bm25.sqlite3"), 0.5)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(ids(other.search("flood", 5))))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(other) == len(DOCUMENTS)
+    assert results == [["flood"]] * 4
@@ -0,0 +1,67 @@
+import pytest
+
+from main import CrawlerService
+
+
+class FailingStart(CrawlerService):
+    # Launch fails after the first browser is up, like a missing Playwright build
+    def __init__(self):
+        super().__init__(pool_size=2, max_pages=2, page_timeout=1)
+        self.starts = 0
+        self.closed = []
+
+    async def _start_crawlers(self):
+        self.starts += 1
+        self._crawlers.append(self)
+        raise RuntimeError("browser not installed")
+
+    async def close(self):
+        self.closed.append(True)
+
+
+class StubCrawls(CrawlerService):
+    # Browsers replaced by a coroutine per URL
+    def __init__(self, crawl_one):
+        super().__init__(pool_size=1, max_pages=2, page_timeout=1)
+        self.crawl_one = crawl_one
+
+    async def _start_crawlers(self):
+        self._next_crawler = iter(())
+
+    async def _crawl_one(self, url):
+        return await self.crawl_one(url)
+
+
+def test_failed_start_resets_so_the_next_start_retries():
+    service = FailingStart()
+    for attempt in (1, 2):
+        with pytest.raises(RuntimeError, match="browser not installed"):
+            service.start()
+        assert service.starts == attempt
+        assert not service.ready
+        assert service.loop is None
+    assert service.closed == [True, True]
+
+
+def test_iter_crawl_yields_every_url():
+    async def crawl_one(url):
+        return url.upper()
+
+    service = StubCrawls(crawl_one)
+    try:
+        items = sorted(service.iter_crawl(["a", "b", "c"], buffer_size=1))
+    finally:
+        service.stop()
+    assert items == [("a", "A"), ("b", "B"), ("c", "C")]
+
+
+def test_iter_crawl_raises_when_the_producer_dies():
+    async def crawl_one(url):
+        raise AttributeError("no pages semaphore")
+
+    service = StubCrawls(crawl_one)
+    try:
+        with pytest.raises(AttributeError, match="no pages semaphore"):
+            list(service.iter_crawl(["a", "b"], buffer_size=2, timeout=None))
+    finally:
+        service.stop()
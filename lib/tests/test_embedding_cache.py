@@ -0,0 +1,63 @@
+import numpy as np
+
+from main import CachedEmbeddingFunction
+
+
+class StubEmbedder:
+    # Each text embeds to four copies of its length, calls are recorded
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text))] * 4 for text in texts]
+
+
+def open_cache(path, embedder=None):
+    return CachedEmbeddingFunction(embedder or StubEmbedder(), str(path), 8, 1)
+
+
+def as_lists(vectors):
+    return [np.asarray(vector).tolist() for vector in vectors]
+
+
+def test_vectors_are_reused_after_reload(tmp_path):
+    open_cache(tmp_path)(["aa", "bbb"])
+    embedder = StubEmbedder()
+    cache = open_cache(tmp_path, embedder)
+    assert as_lists(cache(["bbb", "aa"])) == [[3.0] * 4, [2.0] * 4]
+    assert embedder.calls == []
+
+
+def test_vector_without_key_is_dropped(tmp_path):
+    open_cache(tmp_path)(["aa"])
+    # A crash between the two appends leaves a vector whose key was never written
+    with open(tmp_path / "vectors.f32", "ab") as f:
+        f.write(np.full(4, 99, dtype=np.float32).tobytes())
+    open_cache(tmp_path)(["cccc"])
+    cache = open_cache(tmp_path)
+    assert as_lists(cache(["cccc", "aa"])) == [[4.0] * 4, [2.0] * 4]
+
+
+def test_partial_key_is_dropped(tmp_path):
+    open_cache(tmp_path)(["aa", "bbb"])
+    with open(tmp_path / "keys.txt", "r+b") as f:
+        f.truncate(65 + 10)
+    embedder = StubEmbedder()
+    cache = open_cache(tmp_path, embedder)
+    assert as_lists(cache(["aa", "bbb"])) == [[2.0] * 4, [3.0] * 4]
+    assert embedder.calls == [["bbb"]]
+
+
+def test_instances_sharing_a_directory_keep_rows_apart(tmp_path):
+    first = open_cache(tmp_path)
+    second = open_cache(tmp_path)
+    first(["aa"])
+    second(["bbb"])
+    first(["cccc"])
+    second(["aa", "ddddd"])
+    embedder = StubEmbedder()
+    cache = open_cache(tmp_path, embedder)
+    texts = ["aa", "bbb", "cccc", "ddddd"]
+    assert as_lists(cache(texts)) == [[float(len(t))] * 4 for t in texts]
+    assert embedder.calls == []
@@ -0,0 +1,54 @@
+import random
+
+import pytest
+
+import main
+from main import history_cutoff
+
+
+@pytest.fixture(autouse=True)
+def budget(monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_TOKEN_BUDGET", 100)
+    monkeypatch.setattr(main, "HISTORY_SUMMARY_TOKENS", 20)
+    monkeypatch.setattr(main, "HISTORY_MIN_RECENT", 2)
+    monkeypatch.setattr(main, "HISTORY_SUMMARY_STEP", 3)
+
+
+def messages(*tokens):
+    # estimate_tokens counts four characters per token, plus one
+    return [{"role": "user", "text": "x" * (4 * (n - 1))} for n in tokens]
+
+
+def test_history_within_budget_is_kept():
+    assert history_cutoff([]) == 0
+    assert history_cutoff(messages(*[10] * 10)) == 0
+
+
+def test_cutoff_rounds_up_to_whole_summary_steps():
+    # 120 tokens: the newest 8 fit the 80 left after the summary, so 4 would be
+    # summarized, rounded up to 6
+    assert history_cutoff(messages(*[10] * 12)) == 6
+
+
+def test_recent_messages_stay_verbatim_even_over_budget():
+    assert history_cutoff(messages(10, 10, 200, 200)) == 2
+    assert history_cutoff(messages(500)) == 0
+
+
+def test_cutoff_properties_on_random_histories():
+    rng = random.Random(7)
+    for _ in range(500):
+        tokens = [rng.randint(1, 60) for _ in range(rng.randint(0, 30))]
+        cutoff = history_cutoff(messages(*tokens))
+        if sum(tokens) <= 100:
+            assert cutoff == 0
+            continue
+        kept = len(tokens) - cutoff
+        assert kept >= min(2, len(tokens))
+        assert cutoff % 3 == 0 or kept == 2
+        # What stays verbatim fits next to the summary, unless the last two alone
+        # are too long
+        if sum(tokens[-2:]) > 80:
+            assert kept == 2
+        else:
+            assert sum(tokens[cutoff:]) <= 80
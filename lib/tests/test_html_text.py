@@ -0,0 +1,50 @@
+import sys
+
+import pytest
+
+from conftest import reference_clean_html
+from html_text import clean_html, clean_html_batch
+
+
+def test_matches_reference_on_saved_pages(pages):
+    for name, page in pages.items():
+        assert clean_html(page) == reference_clean_html(page), name
+
+
+@pytest.mark.parametrize(
+    "html",
+    [
+        "",
+        "   ",
+        "<p></p>",
+        "a\\nb\\tc\\rd",
+        "\\\\n",
+        "&lt;p&gt;not a tag&lt;/p&gt;",
+        "&amp;nbsp; &nbsp;&#160;&#x2003;",
+        "&#92;n decoded escape",
+        "<b>no</b>&nbsp;<i>space</i>",
+        "unterminated <tag and &amp text",
+        "\r\n\t\x0b\x0c\x1c\x1d\x1e\x1f\x85  　",
+    ],
+)
+def test_matches_reference_on_edge_cases(html):
+    assert clean_html(html) == reference_clean_html(html)
+
+
+def test_matches_reference_for_every_code_point():
+    # Each code point alone and between words, in chunks to keep failures readable
+    step = 0x1000
+    for start in range(0, sys.maxunicode + 1, step):
+        chars = [chr(c) for c in range(start, min(start + step, sys.maxunicode + 1))]
+        for text in ("".join(chars), "x".join(chars), " <i>".join(chars)):
+            assert clean_html(text) == reference_clean_html(text), hex(start)
+
+
+def test_batch_keeps_order_and_output(pages):
+    html = list(pages.values()) * 3
+    assert clean_html_batch(html, max_workers=2) == [clean_html(p) for p in html]
+
+
+def test_batch_handles_small_inputs():
+    assert clean_html_batch([]) == []
+    assert clean_html_batch(["<p>one</p>"]) == ["one"]
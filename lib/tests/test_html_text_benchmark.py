@@ -0,0 +1,35 @@
+import pytest
+
+from conftest import reference_clean_html
+from html_text import clean_html, clean_html_batch
+
+pytest.importorskip("pytest_benchmark")
+
+# Crawled pages are often several hundred KB, the saved pages are repeated up to that
+PAGE_BYTES = 300 * 1024
+
+
+def scaled(page):
+    return page * max(PAGE_BYTES // len(page), 1)
+
+
+@pytest.fixture(scope="module")
+def large_pages(pages):
+    return {name: scaled(page) for name, page in pages.items()}
+
+
+@pytest.mark.parametrize("implementation", [clean_html, reference_clean_html])
+def test_clean_html_speed(benchmark, large_pages, implementation):
+    benchmark.group = "clean_html"
+    html = list(large_pages.values())
+    result = benchmark(lambda: [implementation(page) for page in html])
+    assert result == [reference_clean_html(page) for page in html]
+
+
+def test_clean_html_batch_speed(benchmark, large_pages):
+    benchmark.group = "clean_html_batch"
+    html = list(large_pages.values()) * 4
+    result = benchmark.pedantic(
+        clean_html_batch, args=(html,), kwargs={"max_workers": 4}, rounds=3
+    )
+    assert len(result) == len(html)
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def packs(tmp_path, monkeypatch):
+    # A pack file of its own and a fresh in-memory copy for every test
+    path = tmp_path / "knowledge_packs.json"
+    monkeypatch.setattr(main, "KNOWLEDGE_PACK_PATH", str(path))
+    monkeypatch.setattr(
+        main, "knowledge_packs", main.LazyService("packs", main.load_knowledge_packs)
+    )
+    monkeypatch.setattr(main, "reference_cache", main.TTLCache(10, 60))
+    return path
+
+
+def write(path, data):
+    path.write_text(json.dumps(data), encoding="utf-8")
+
+
+def read(path):
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def test_edit_keeps_changes_from_other_writers(packs):
+    write(packs, {"fire": {"smoke": ["old"]}})
+    loaded = main.knowledge_packs.get()
+    # Another process adds a pack after this one loaded the file
+    write(packs, {"fire": {"smoke": ["old"]}, "flood": {}})
+    with main.edit_knowledge_packs() as current:
+        current["fire"]["exit"] = ["door"]
+    assert read(packs) == {"fire": {"smoke": ["old"], "exit": ["door"]}, "flood": {}}
+    assert main.knowledge_packs.get() is loaded
+    assert loaded == read(packs)
+
+
+def test_edit_saves_nothing_on_error(packs):
+    write(packs, {"fire": {}})
+    with pytest.raises(RuntimeError):
+        with main.edit_knowledge_packs() as current:
+            current["flood"] = {}
+            raise RuntimeError
+    assert read(packs) == {"fire": {}}
+
+
+def test_refresh_references_merges_with_the_file(packs, monkeypatch):
+    write(packs, {"fire": {"smoke": ["old"], "exit": ["old"], "gas": ["old"]}})
+    main.knowledge_packs.get()
+    # ingest.py rewrote "exit" and added "burn" since the server loaded the packs
+    write(
+        packs,
+        {"fire": {"smoke": ["old"], "exit": ["new"], "gas": ["old"], "burn": ["b"]}},
+    )
+
+    def rerank(db_query, rerank_query, skipped=None, **kwargs):
+        if db_query == "gas":
+            skipped.append("rerank")
+        return [f"fresh {db_query}"]
+
+    monkeypatch.setattr(main, "retrieve_and_rerank", rerank)
+    main.refresh_references(["old"])
+    assert read(packs) == {
+        "fire": {"smoke": ["fresh smoke"], "exit": ["new"], "burn": ["b"]}
+    }
+    assert main.knowledge_packs.get() == read(packs)
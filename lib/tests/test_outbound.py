@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pytest
+
+import main
+from main import SingleFlight, TokenBucket
+
+
+class FakeTime:
+    # Stands in for the time module inside main, sleeping only moves the clock
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(main, "time", fake)
+    return fake
+
+
+def test_token_bucket_serves_burst_then_spaces_callers(clock):
+    bucket = TokenBucket(rate=10, burst=2)
+    waits = [bucket.reserve() for _ in range(4)]
+    assert waits == pytest.approx([0.0, 0.0, 0.1, 0.2])
+
+
+def test_token_bucket_refills_up_to_burst(clock):
+    bucket = TokenBucket(rate=10, burst=2)
+    bucket.reserve()
+    bucket.reserve()
+    clock.now += 60
+    assert [bucket.reserve() for _ in range(3)] == pytest.approx([0.0, 0.0, 0.1])
+
+
+def test_token_bucket_acquire_sleeps_and_zero_rate_never_waits(clock):
+    bucket = TokenBucket(rate=4, burst=1)
+    assert bucket.acquire() == 0.0
+    start = clock.now
+    assert bucket.acquire() == pytest.approx(0.25)
+    assert clock.now - start == pytest.approx(0.25)
+    unlimited = TokenBucket(rate=0, burst=1)
+    assert [unlimited.reserve() for _ in range(5)] == [0.0] * 5
+
+
+def run_concurrently(flight, key, fn, n):
+    results = []
+    errors = []
+
+    def call():
+        try:
+            results.append(flight.do(key, fn))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    threads, results, errors = run_concurrently(flight, ("svc", "k"), fetch, 5)
+    # Let every caller reach the flight before the leader returns
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls == [1]
+    assert results == ["result"] * 5
+    assert errors == []
+    # Finished flights are forgotten, the next call goes out again
+    assert flight.do(("svc", "k"), lambda: "again") == "again"
+
+
+def test_single_flight_shares_errors_and_keeps_keys_apart():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise RuntimeError("down")
+
+    threads, results, errors = run_concurrently(flight, ("svc", "a"), fail, 3)
+    time.sleep(0.2)
+    assert flight.do(("svc", "b"), lambda: "other key") == "other key"
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == []
+    assert [str(e) for e in errors] == ["down"] * 3
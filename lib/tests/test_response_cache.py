@@ -0,0 +1,101 @@
+from main import SemanticCache
+
+VECTORS = {
+    "smoke in the kitchen": [1.0, 0.0, 0.0],
+    "kitchen smoke": [0.95, 0.31, 0.0],
+    "water in the basement": [0.0, 0.0, 1.0],
+}
+
+
+class StubEmbedder:
+    # Fixed vectors for known queries, counting calls; anything else is orthogonal
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+
+    def __call__(self, texts):
+        self.calls += 1
+        if self.fail:
+            raise RuntimeError("model not loaded")
+        return [VECTORS.get(text, [0.0, 1.0, 0.0]) for text in texts]
+
+
+def make_cache(embed, maxsize=10, ttl=60, ready=lambda: True):
+    return SemanticCache(embed, maxsize, ttl, 0.9, ready=ready)
+
+
+def test_similar_queries_hit_within_their_bucket():
+    embed = StubEmbedder()
+    cache = make_cache(embed)
+    cache.set("fire", "Smoke in the  kitchen", "open a window")
+    assert cache.get("fire", "kitchen smoke") == "open a window"
+    assert cache.get("fire", "water in the basement") is None
+    assert cache.get("flood", "kitchen smoke") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_exact_repeats_skip_the_embedding():
+    embed = StubEmbedder()
+    cache = make_cache(embed)
+    cache.set("fire", "smoke in the kitchen", "open a window")
+    calls = embed.calls
+    assert cache.get("fire", "SMOKE in the kitchen") == "open a window"
+    assert embed.calls == calls
+
+
+def test_entries_expire_and_evict_least_recently_used():
+    cache = make_cache(StubEmbedder(), ttl=-1)
+    cache.set("fire", "smoke in the kitchen", "stale")
+    assert cache.get("fire", "smoke in the kitchen") is None
+    assert cache.stats()["size"] == 0
+
+    cache = make_cache(StubEmbedder(), maxsize=2)
+    cache.set("fire", "smoke in the kitchen", "a")
+    cache.set("flood", "water in the basement", "b")
+    cache.get("fire", "smoke in the kitchen")
+    cache.set("other", "something else", "c")
+    assert cache.get("flood", "water in the basement") is None
+    assert cache.get("fire", "smoke in the kitchen") == "a"
+
+
+def test_embedding_failures_and_cold_model_fail_open():
+    embed = StubEmbedder()
+    cache = make_cache(embed)
+    cache.set("fire", "smoke in the kitchen", "open a window")
+    embed.fail = True
+    assert cache.get("fire", "kitchen smoke") is None
+
+    embed = StubEmbedder()
+    ready = {"value": True}
+    cache = make_cache(embed, ready=lambda: ready["value"])
+    cache.set("fire", "smoke in the kitchen", "open a window")
+    ready["value"] = False
+    calls = embed.calls
+    assert cache.get("fire", "kitchen smoke") is None
+    assert embed.calls == calls
+
+
+def test_answers_stored_while_cold_hit_on_exact_repeats():
+    embed = StubEmbedder()
+    ready = {"value": False}
+    cache = make_cache(embed, ready=lambda: ready["value"])
+    cache.set("fire", "smoke in the kitchen", "open a window")
+    assert embed.calls == 0
+    assert cache.get("fire", "Smoke in the kitchen") == "open a window"
+    # Once the model is loaded the entry still has no vector to compare against
+    ready["value"] = True
+    assert cache.get("fire", "kitchen smoke") is None
+    cache.set("fire", "water in the basement", "move upstairs")
+    assert cache.get("fire", "kitchen smoke") is None
+    cache.set("fire", "smoke in the kitchen", "open a window")
+    assert cache.get("fire", "kitchen smoke") == "open a window"
+
+
+def test_answers_stored_when_embedding_fails():
+    embed = StubEmbedder()
+    embed.fail = True
+    cache = make_cache(embed)
+    cache.set("fire", "smoke in the kitchen", "open a window")
+    assert cache.get("fire", "smoke in the kitchen") == "open a window"
+    assert cache.stats()["size"] == 1
@@ -0,0 +1,53 @@
+import pytest
+
+import main
+from main import adaptive_cut, chunk_text, reciprocal_rank_fusion
+
+
+def words(n):
+    return " ".join(f"w{i}" for i in range(n))
+
+
+def test_chunk_text_short_and_empty():
+    assert chunk_text("") == []
+    assert chunk_text("   ") == []
+    assert chunk_text("one two three", max_tokens=4, overlap=1) == ["one two three"]
+    assert chunk_text(words(4), max_tokens=4, overlap=1) == [words(4)]
+
+
+def test_chunk_text_overlaps_and_covers_every_word():
+    chunks = chunk_text(words(10), max_tokens=4, overlap=1)
+    assert chunks == ["w0 w1 w2 w3", "w3 w4 w5 w6", "w6 w7 w8 w9"]
+    for n in range(1, 60):
+        chunks = [chunk.split() for chunk in chunk_text(words(n), 8, 3)]
+        assert all(len(chunk) <= 8 for chunk in chunks)
+        assert chunks[0][0] == "w0" and chunks[-1][-1] == f"w{n - 1}"
+        for previous, current in zip(chunks, chunks[1:]):
+            assert previous[-3:] == current[:3]
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a", "d"]], k=60)
+    assert [doc_id for doc_id, _ in fused] == ["a", "c", "b", "d"]
+    assert dict(fused)["a"] == pytest.approx(1 / 61 + 1 / 62)
+    assert reciprocal_rank_fusion([[], []]) == []
+
+
+@pytest.fixture
+def cut(monkeypatch):
+    monkeypatch.setattr(main, "RERANK_MIN_CANDIDATES", 2)
+    monkeypatch.setattr(main, "RERANK_MAX_CANDIDATES", 4)
+    monkeypatch.setattr(main, "RERANK_CUT_RATIO", 0.5)
+
+
+def test_adaptive_cut_keeps_close_scores(cut):
+    assert adaptive_cut([]) == []
+    candidates = [("a", 1.0), ("b", 0.2), ("c", 0.6), ("d", 0.5), ("e", 0.4)]
+    # The minimum is kept whatever its score, then only scores >= half the best
+    assert adaptive_cut(candidates) == ["a", "b", "c", "d"]
+    assert adaptive_cut([("a", 1.0), ("b", 0.1), ("c", 0.1)]) == ["a", "b"]
+
+
+def test_adaptive_cut_caps_candidates(cut):
+    candidates = [(str(i), 1.0) for i in range(10)]
+    assert adaptive_cut(candidates) == ["0", "1", "2", "3"]
@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+
+import main
+from main import Deadline, run_stage, run_stages
+
+
+def stage_threads():
+    return [t for t in threading.enumerate() if t.name.startswith("stage-")]
+
+
+def wait_for_stage_threads(timeout=5):
+    deadline = time.monotonic() + timeout
+    while stage_threads() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return stage_threads()
+
+
+def double(x):
+    return x * 2
+
+
+def test_run_stage_keeps_order():
+    assert list(run_stage(range(10), double, 2)) == [x * 2 for x in range(10)]
+
+
+def test_run_stage_raises_worker_errors():
+    def fail_on_three(x):
+        if x == 3:
+            raise ValueError("bad item")
+        return x
+
+    with pytest.raises(ValueError, match="bad item"):
+        list(run_stage(range(10), fail_on_three, 2))
+
+
+def test_run_stage_worker_stops_when_consumer_stops():
+    closed = threading.Event()
+
+    def source():
+        try:
+            for i in range(1000):
+                yield i
+        finally:
+            closed.set()
+
+    stage = run_stage(source(), double, 1)
+    with pytest.raises(RuntimeError):
+        for _ in stage:
+            raise RuntimeError("store failed")
+    stage.close()
+    assert wait_for_stage_threads() == []
+    assert closed.wait(5)
+
+
+@pytest.fixture
+def budgets(monkeypatch):
+    monkeypatch.setattr(main, "ANSWER_RESERVE", 0)
+    monkeypatch.setitem(main.STAGE_BUDGETS, "keywords", 1)
+    monkeypatch.setitem(main.STAGE_BUDGETS, "references", 0.2)
+    monkeypatch.setitem(main.STAGE_BUDGETS, "transcription", 1)
+
+
+def test_run_stages_passes_dependencies_and_merges_skipped(budgets):
+    def references(keywords, skipped):
+        skipped.append("crawl")
+        return keywords + ["refs"]
+
+    stages = {
+        "keywords": ((), lambda skipped: ["kw"]),
+        "references": (("keywords",), references),
+    }
+    timings = {}
+    skipped = []
+    results = dict(run_stages(stages, timings, Deadline(30), skipped))
+    assert results == {"keywords": ["kw"], "references": ["kw", "refs"]}
+    assert skipped == ["crawl"]
+    assert set(timings) == {"keywords", "references"}
+
+
+def test_run_stages_drops_late_and_failed_stages(budgets):
+    finished = threading.Event()
+
+    def slow(skipped):
+        time.sleep(0.5)
+        skipped.append("rerank")
+        finished.set()
+
+    def fail(skipped):
+        skipped.append("search")
+        raise RuntimeError("down")
+
+    stages = {
+        "references": ((), slow),
+        "transcription": ((), fail),
+        "keywords": ((), lambda skipped: "kw"),
+    }
+    skipped = []
+    results = dict(run_stages(stages, {}, Deadline(30), skipped))
+    assert results == {"references": None, "transcription": None, "keywords": "kw"}
+    assert sorted(skipped) == ["references", "transcription"]
+    # The abandoned stage finishes later without touching the request's list
+    assert finished.wait(5)
+    assert sorted(skipped) == ["references", "transcription"]
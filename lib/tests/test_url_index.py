@@ -0,0 +1,60 @@
+import uuid
+
+import chromadb
+import pytest
+
+import main
+
+
+@pytest.fixture
+def collection(tmp_path, monkeypatch):
+    # Stored with explicit embeddings, so no embedding model is needed
+    client = chromadb.PersistentClient(path=str(tmp_path / "chroma"))
+    collection = client.create_collection(f"test-{uuid.uuid4().hex[:8]}")
+    monkeypatch.setattr(main, "get_collection", lambda: collection)
+    monkeypatch.setattr(
+        main, "bm25_index", main.BM25Index(str(tmp_path / "bm25.sqlite3"), 0.5)
+    )
+    monkeypatch.setattr(main, "url_index", {})
+    monkeypatch.setattr(main, "index_state", {"count": 0, "checked": 0.0})
+    monkeypatch.setattr(main, "INDEX_SYNC_INTERVAL", 0)
+    return collection
+
+
+def add_page(collection, url, n=1):
+    ids = [f"{url}-{i}" for i in range(n)]
+    collection.add(
+        ids=ids,
+        documents=[f"page {url} chunk {i}" for i in range(n)],
+        embeddings=[[float(i), 1.0] for i in range(n)],
+        metadatas=[{"url": url, "timestamp": "2024-01-01"} for _ in ids],
+    )
+    return ids
+
+
+def test_build_indexes_backfills_bm25_once(collection):
+    add_page(collection, "a", 3)
+    main.build_indexes(collection)
+    assert set(main.url_index) == {"a"}
+    assert main.index_state["count"] == 3
+    assert len(main.bm25_index) == 3
+    main.bm25_index.add(["extra"], ["not in the collection"])
+    main.build_indexes(collection, bm25=False)
+    assert len(main.bm25_index) == 4
+
+
+def test_picks_up_pages_stored_by_another_process(collection):
+    add_page(collection, "a")
+    main.build_indexes(collection)
+    assert main.filter_urls(["a", "b"]) == ["b"]
+    # Written straight to the collection, as another worker or ingest.py would
+    add_page(collection, "b", 2)
+    assert main.filter_urls(["a", "b", "c"]) == ["c"]
+    assert main.index_state["count"] == 3
+
+
+def test_sync_is_throttled(collection, monkeypatch):
+    main.build_indexes(collection)
+    monkeypatch.setattr(main, "INDEX_SYNC_INTERVAL", 3600)
+    add_page(collection, "a")
+    assert main.filter_urls(["a"]) == ["a"]
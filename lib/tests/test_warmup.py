@@ -0,0 +1,52 @@
+import threading
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def warmer(monkeypatch):
+    # A "flaky" service whose warm-up fails until told otherwise
+    calls = []
+    state = {"fail": True}
+
+    def load():
+        calls.append(threading.current_thread().name)
+        if state["fail"]:
+            raise RuntimeError("model download failed")
+
+    monkeypatch.setitem(main.WARMERS, "flaky", load)
+    monkeypatch.setattr(main, "warmup_started", set())
+    monkeypatch.setattr(main, "warmup_failures", {})
+    monkeypatch.setattr(main, "WARMUP_RETRY_BASE", 10)
+    monkeypatch.setattr(main, "WARMUP_RETRY_MAX", 15)
+    return calls, state
+
+
+def test_failed_warmup_waits_for_its_backoff(warmer, monkeypatch):
+    calls, _ = warmer
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    main.warm(["flaky"])
+    assert calls == ["MainThread"]
+    assert main.warmup_failures["flaky"] == (1, 1010.0)
+    # Requests inside the backoff do not start it again
+    monkeypatch.setattr(main, "warm", lambda names: None)
+    main.start_warmup(["flaky"])
+    assert "flaky" not in main.warmup_started
+    now[0] = 1010.0
+    main.start_warmup(["flaky"])
+    assert "flaky" in main.warmup_started
+
+
+def test_backoff_doubles_up_to_the_cap_and_resets(warmer, monkeypatch):
+    _, state = warmer
+    monkeypatch.setattr(main.time, "monotonic", lambda: 0.0)
+    for expected in (10.0, 15.0, 15.0):
+        main.warm(["flaky"])
+        assert main.warmup_failures["flaky"][1] == expected
+    assert main.warmup_failures["flaky"][0] == 3
+    state["fail"] = False
+    main.warm(["flaky"])
+    assert "flaky" not in main.warmup_failures